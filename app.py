@@ -1,88 +1,420 @@
-from datetime import datetime
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
 from contextlib import asynccontextmanager
-from io import StringIO
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from typing import Literal
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+import numpy as np
+import pandas as pd
 
-from find_terminals_to_cash_out import PoiStats, BEST_CASH_WEIGHT, BEST_NUM_OF_TERMINALS_TO_CASH_OUT
-from get_routes import return_optimal_route
-from prepare_data import create_distance_matrix, get_mappings, prepare_data
-from schedule_report import create_report_for_schedules, get_schedules_of_vehicles, postprocess_schedules
+import metrics
+from calculate_costs import CostAccumulator
+from find_terminals_to_cash_out import PoiStats
+from get_routes import ROUTING_PROFILES, init_worker, return_optimal_route_in_worker
+from income_store import INCOME_STORE_DIR, IncomeStore, open_income_store
+from jobs import DONE, PENDING, RUNNING, Job, JobManager, JobQueueFull
+from report_writer import MEDIA_TYPES, iter_report
+from results_cache import LRUCache
+from schedule_report import create_schedules_report
+from snapshot import SNAPSHOT_DIR, load_or_make_snapshot
+from state_store import open_state_store
 
 
 OPTIMAL_NUM_OF_VEHICLES = 8
+# routes are searched in separate processes, so the server is not blocked by the solver
+NUM_ROUTING_WORKERS = int(os.environ.get("NUM_ROUTING_WORKERS", 1))
+MAX_ACTIVE_JOBS = int(os.environ.get("MAX_ACTIVE_JOBS", 8))
+# routes of a day are cached, directory is optional to keep results between restarts
+ROUTES_CACHE_SIZE = int(os.environ.get("ROUTES_CACHE_SIZE", 32))
+ROUTES_CACHE_DIR = os.environ.get("ROUTES_CACHE_DIR")
+# prepared state of the service, it is made by `python snapshot.py`, without it source files are read at startup
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_DIR", SNAPSHOT_DIR)
+# state of days planning: memory is only for one process, sqlite:///path or file:///path can be shared by workers
+STATE_STORE = os.environ.get("STATE_STORE", "memory")
+# incomes of days ingested by income_store.py, without it income of the first day is used for every day
+INCOME_STORE_PATH = os.environ.get("INCOME_STORE_DIR", INCOME_STORE_DIR)
+# concurrent advances of the day are retried this number of times
+MAX_ADVANCE_ATTEMPTS = 10
 app_data = {}
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    incomes, times_from_terminal_to_terminal = prepare_data()
+    with metrics.span("startup"):
+        # snapshot made from other source files is rebuilt from them
+        snapshot = load_or_make_snapshot(SNAPSHOT_PATH)
+        ctx = snapshot.data_context()
 
-    # Just to immitate how it should work: initial terminals balance from yesterday and income today
-    terminals_account_balance = {
-        terminal: balance
-        for _, (terminal, balance) in incomes.query("timestamp == '2022-08-31'")[["TID", "cash"]].iterrows()
-    }
-    terminals_income = {
-        terminal: balance
-        for _, (terminal, balance) in incomes.query("timestamp == '2022-09-01'")[["TID", "cash"]].iterrows()
-    }
-    terminal_id_to_idx, idx_to_terminal_id = get_mappings()
-    times_from_terminal_to_terminal["Destination_tid_idx"] = (
-        times_from_terminal_to_terminal["Destination_tid"].map(terminal_id_to_idx)
-    )
-
-    distance_matrix = create_distance_matrix()
-
-    # Load the data into app_data
-    app_data["terminals_account_balance"] = terminals_account_balance
-    app_data["terminals_income"] = terminals_income
-    app_data["distance_matrix"] = distance_matrix
-    app_data["terminal_id_to_idx"] = terminal_id_to_idx
-    app_data["idx_to_terminal_id"] = idx_to_terminal_id
-
-    app_data["stat_obj"] = PoiStats(
-        terminals_account_balance,
-        BEST_NUM_OF_TERMINALS_TO_CASH_OUT,
-        start_date='2022-08-31 00:00:00',  # start date for our initial data
-        weights=(BEST_CASH_WEIGHT, 1 - BEST_CASH_WEIGHT)
-    )
+        # Load the data into app_data
+        # Just to immitate how it should work: initial terminals balance from yesterday and income today
+        # arrays are aligned with terminals of stat_obj
+        app_data["data_context"] = ctx
+        app_data["terminals_account_balance"] = snapshot.cash[:, 0]
+        app_data["terminals_income"] = snapshot.cash[:, 1]
+        app_data["terminals_ids"] = snapshot.tids
+        app_data["income_store"] = open_income_store(INCOME_STORE_PATH)
+        app_data["distance_matrix"] = ctx.distance_matrix
+        app_data["terminal_id_to_idx"] = ctx.tid_2_idx
+        app_data["idx_to_terminal_id"] = ctx.idx_2_tid
+
+        # state after the first planning day, next days are only planned by explicit /advance_day request
+        # state saved by another worker or before restart is used as is
+        app_data["state_store"] = open_state_store(STATE_STORE)
+        if app_data["state_store"].latest_version() == 0:
+            stat_obj = snapshot.stat_obj()
+            # costs of the first planning day, cash of initial balance is cash at the end of previous day
+            costs = CostAccumulator()
+            costs.add_day(planned_day(stat_obj), snapshot.cash[:, 0], stat_obj._daily_mask, OPTIMAL_NUM_OF_VEHICLES)
+            app_data["state_store"].compare_and_swap(
+                0, {**stat_obj.to_state(), **costs.to_state()}, str(stat_obj._state_date)
+            )
+
+        app_data["routes_cache"] = LRUCache(max_size=ROUTES_CACHE_SIZE, cache_dir=ROUTES_CACHE_DIR)
+        app_data["active_jobs_by_key"] = {}
+        app_data["jobs"] = JobManager(
+            max_workers=NUM_ROUTING_WORKERS,
+            max_active_jobs=MAX_ACTIVE_JOBS,
+            initializer=init_worker,
+            # workers memory-map the same matrix file instead of getting a copy
+            initargs=(ctx.distance_matrix_path or ctx.distance_matrix, ctx.tid_2_idx, ctx.idx_2_tid),
+        )
+    # time from start of the process, including imports
+    metrics.REGISTRY.set("process_startup_seconds", metrics.process_uptime())
     yield
+    app_data["jobs"].shutdown()
+    if "sync_manager" in app_data:
+        app_data["sync_manager"].shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+def sync_manager():
+    """Return manager of queues and events to get intermediate solutions from workers, it is started on first use."""
+    if "sync_manager" not in app_data:
+        app_data["sync_manager"] = multiprocessing.get_context("spawn").Manager()
+    return app_data["sync_manager"]
+
+
+def current_stat_obj() -> tuple[int, PoiStats]:
+    """Return the latest version of PoiStats state, it is loaded from the store only if another process changed it."""
+    store = app_data["state_store"]
+    if app_data.get("stat_obj_version") != store.latest_version():
+        version, state = store.latest()
+        app_data["stat_obj"], app_data["costs"] = PoiStats.from_state(state), CostAccumulator.from_state(state)
+        app_data["stat_obj_version"] = version
+    return app_data["stat_obj_version"], app_data["stat_obj"]
+
+
+def current_costs() -> CostAccumulator:
+    """Return costs of the latest version of state."""
+    current_stat_obj()
+    return app_data["costs"]
+
+
+def day_income(day: pd.Timestamp) -> np.ndarray:
+    """
+    Return income of the day aligned with terminals of stat_obj, only this day is read from incomes store.
+    Index of the store is reread if the day is not there, because days are ingested by another process.
+    """
+    if app_data["income_store"] is None:
+        return app_data["terminals_income"]
+    if day not in app_data["income_store"]:
+        app_data["income_store"] = IncomeStore(INCOME_STORE_PATH)
+        if day not in app_data["income_store"]:
+            raise HTTPException(status_code=409, detail=f"Incomes of {day:%Y-%m-%d} are not ingested")
+    return app_data["income_store"].day_for(day, app_data["terminals_ids"])
+
+
+def planned_day(stat_obj: PoiStats) -> str:
+    return stat_obj._state_date.strftime("%Y-%m-%d")
+
+
+def planning_day() -> str:
+    return str(current_stat_obj()[1]._state_date)
+
+
+def routes_cache_key() -> str:
+    """Return key of routes of the current day: date, terminals to cash out and cash in terminals."""
+    _, stat_obj = current_stat_obj()
+    digest = hashlib.sha1()
+    digest.update(np.asarray(sorted(stat_obj._daily_list), dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(stat_obj.balances).tobytes())
+    return f"{planning_day()}:{digest.hexdigest()[:16]}"
+
+
+def merge_worker_metrics(result: tuple[list[list[int]], dict]) -> list[list[int]]:
+    """Merge solver metrics from a worker process and return routes."""
+    routes, snapshot = result
+    metrics.registry().merge(snapshot)
+    return routes
+
+
+def cache_routes_handler(key: str, stop_event):
+    """
+    Return result handler of routes job which caches routes as soon as the job is finished,
+    so the next request of the day doesn't run the solver even if the result is never fetched.
+    Routes of a search stopped by the client (stop_event is set) are not the best ones, so they are not cached.
+    """
+    def handle_result(result: tuple[list[list[int]], dict]) -> list[list[int]]:
+        routes = merge_worker_metrics(result)
+        if routes is not None and not stop_event.is_set():
+            app_data["routes_cache"].put(key, {"routes": routes})
+        return routes
+    return handle_result
+
+
+def submit_routes_job() -> Job:
+    """Submit search of optimal routes for the current day, if they are not cached or searched already."""
+    key = routes_cache_key()
+    cached = app_data["routes_cache"].get(key)
+    if cached is not None:
+        return app_data["jobs"].add_finished(cached["routes"], meta={"day": planning_day(), "key": key})
+
+    # the same day is requested while its routes are searched
+    job = app_data["active_jobs_by_key"].get(key)
+    if job is not None and app_data["jobs"].get(job.id) is job and job.status in (PENDING, RUNNING):
+        return job
+
+    # cancelled job stops the solver on its next solution
+    stop_event = sync_manager().Event()
+    try:
+        job = app_data["jobs"].submit(
+            return_optimal_route_in_worker,
+            terminals_to_cash_out=current_stat_obj()[1]._daily_list,
+            num_vehicles=OPTIMAL_NUM_OF_VEHICLES,
+            # most of terminals are the same as yesterday, so yesterday routes are a good start solution
+            initial_routes=app_data.get("previous_routes"),
+            config=ROUTING_PROFILES["fast"],
+            stop_event=stop_event,
+            with_metrics=True,
+            meta={"day": planning_day(), "key": key},
+            result_handler=cache_routes_handler(key, stop_event),
+        )
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    app_data["active_jobs_by_key"][key] = job
+
+    def remember_routes(future):
+        app_data["active_jobs_by_key"].pop(key, None)
+        # routes of cancelled job are not a start solution, only its metrics are merged by the result handler
+        if not future.cancelled() and not job.cancelled and future.exception() is None:
+            app_data["previous_routes"], _ = future.result()
+    job.future.add_done_callback(remember_routes)
+    return job
+
+
+def submit_streaming_routes_job() -> tuple[Job, object, object]:
+    """Submit search of optimal routes which puts every better solution into a queue."""
+    solutions_queue = sync_manager().Queue()
+    stop_event = sync_manager().Event()
+    key = routes_cache_key()
+    try:
+        job = app_data["jobs"].submit(
+            return_optimal_route_in_worker,
+            terminals_to_cash_out=current_stat_obj()[1]._daily_list,
+            num_vehicles=OPTIMAL_NUM_OF_VEHICLES,
+            initial_routes=app_data.get("previous_routes"),
+            config=ROUTING_PROFILES["fast"],
+            solutions_queue=solutions_queue,
+            stop_event=stop_event,
+            with_metrics=True,
+            meta={"day": planning_day(), "key": key},
+            result_handler=cache_routes_handler(key, stop_event),
+        )
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return job, solutions_queue, stop_event
+
+
+def format_event(event: dict, stream: str) -> str:
+    data = json.dumps(event, ensure_ascii=False)
+    return f"data: {data}\n\n" if stream == "sse" else f"{data}\n"
+
+
+async def stream_routes_response(stream: str) -> StreamingResponse:
+    """Stream every better solution of the solver as server-sent events or NDJSON, the last event is "done"."""
+    day = planning_day()
+    cached = app_data["routes_cache"].get(routes_cache_key())
+    if cached is not None:
+        events = iter([format_event({"event": "done", "day": day, "status": DONE, "routes": cached["routes"]}, stream)])
+    else:
+        job, solutions_queue, stop_event = submit_streaming_routes_job()
+
+        async def events():
+            try:
+                while True:
+                    try:
+                        solution = await run_in_threadpool(solutions_queue.get, True, 0.5)
+                    except queue.Empty:
+                        if job.finished_at is not None:
+                            break
+                        continue
+                    yield format_event({"event": "solution", "day": day, **solution}, stream)
+                if job.result is not None:
+                    app_data["previous_routes"] = job.result
+                yield format_event({"event": "done", "day": day, "status": job.status, "routes": job.result}, stream)
+            finally:
+                # client has got enough or disconnected, so the solver can stop
+                stop_event.set()
+        events = events()
+
+    media_type = "text/event-stream" if stream == "sse" else "application/x-ndjson"
+    return StreamingResponse(events, media_type=media_type)
+
+
+def make_routes_report(day: str, routes: list[list[int]]) -> pd.DataFrame:
+    """Return report with schedules of vehicles."""
+    result = {day: {"route": routes, "num_vehicles": OPTIMAL_NUM_OF_VEHICLES}}
+
+    return create_schedules_report(result, app_data["data_context"]).drop("день", axis=1)
+
+
+async def job_report_response(job: Job, report_format: str = "csv") -> StreamingResponse:
+    # report is built in a thread only once and kept with the job, routes are cached when the job is finished
+    if "report" not in job.meta:
+        job.meta["report"] = await run_in_threadpool(make_routes_report, job.meta["day"], job.result)
+
+    # return result as file in requested format, it is sent by chunks while they are written
+    report = iter_report({"маршруты": (job.meta["report"], False)}, report_format)
+    response = StreamingResponse(metrics.timed_iter("render_report", report), media_type=MEDIA_TYPES[report_format])
+    response.headers["Content-Disposition"] = f"attachment; filename=export.{report_format}"
+    return response
+
+
+def get_job_or_404(job_id: str) -> Job:
+    job = app_data["jobs"].get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} is not found")
+    return job
+
+
+@app.post("/advance_day")
+async def advance_day(day: str = None):
+    """
+    Go to the next planning day: update terminals cash and get terminals to cash out.
+    If day is given, the day is advanced only if it is the current planning day, otherwise 409 is returned,
+    so a retried request doesn't advance twice.
+    """
+    store = app_data["state_store"]
+    for _ in range(MAX_ADVANCE_ATTEMPTS):
+        version, stat_obj = current_stat_obj()
+        costs = CostAccumulator.from_state(app_data["costs"].to_state())
+        if day is not None and pd.Timestamp(day) != stat_obj._state_date:
+            raise HTTPException(status_code=409, detail=f"Planning day is {stat_obj._state_date}, not {day}")
+        # the shared object is not changed, if another process advances the day first
+        stat_obj = PoiStats.from_state(stat_obj.to_state())
+        # costs of the day depend on cash at the end of previous day, update_day doesn't change this array
+        previous_balances = stat_obj.balances
+        stat_obj.update_day(day_income(stat_obj._state_date + pd.Timedelta(days=1)))
+        day_costs = costs.add_day(
+            planned_day(stat_obj), previous_balances, stat_obj._daily_mask, OPTIMAL_NUM_OF_VEHICLES
+        )
+        if store.compare_and_swap(version, {**stat_obj.to_state(), **costs.to_state()}, str(stat_obj._state_date)):
+            app_data["stat_obj"], app_data["costs"], app_data["stat_obj_version"] = stat_obj, costs, version + 1
+            return {
+                "day": str(stat_obj._state_date),
+                "num_terminals": len(stat_obj._daily_list),
+                "version": version + 1,
+                "costs": day_costs,
+            }
+    raise HTTPException(status_code=409, detail="Planning day is changed concurrently, try again")
+
+
+@app.get("/costs")
+async def get_costs(day: str = None):
+    """Return funding, collection and vehicles costs of every planned day (or only of day) and totals."""
+    costs = current_costs()
+    days = costs.report()
+    if day is not None:
+        days = [day_costs for day_costs in days if day_costs["day"] == pd.Timestamp(day).strftime("%Y-%m-%d")]
+        if not days:
+            raise HTTPException(status_code=404, detail=f"Day {day} is not planned")
+    return {"days": days, "totals": costs.totals()}
+
+
+@app.get("/state/history")
+async def state_history():
+    """Return version and day of every saved state of days planning."""
+    return app_data["state_store"].history()
+
+
+@app.middleware("http")
+async def add_timing_header(request: Request, call_next):
+    """If request has header X-Timing, return time of every stage of the request in Server-Timing header."""
+    if "x-timing" not in request.headers:
+        return await call_next(request)
+    with metrics.trace() as spans:
+        response = await call_next(request)
+    # streamed body is not rendered yet, so its time is only in /metrics
+    response.headers["Server-Timing"] = metrics.server_timing(spans)
+    return response
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Return metrics in Prometheus text format."""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "ok",
+        "active_jobs": app_data["jobs"].num_active_jobs(),
+        "startup_seconds": metrics.REGISTRY.snapshot()["gauges"].get(("process_startup_seconds", ())),
+    }
+
+
 # one API enpoint
 @app.get("/find_optimal_routes", response_class=StreamingResponse)
-async def find_optimal_routes(): # terminals_income: dict[int, float]
-    # update day and get list of points
-    app_data["stat_obj"].update_day(app_data["terminals_income"])
-    termials_to_cash_out = app_data["stat_obj"]._daily_list
-
-    # get optimal routes
-    routes = return_optimal_route(
-        distance_matrix=app_data["distance_matrix"],
-        terminals_to_cash_out=termials_to_cash_out,
-        tid_2_idx=app_data["terminal_id_to_idx"],
-        idx_2_tid=app_data["idx_to_terminal_id"],
-        num_vehicles=OPTIMAL_NUM_OF_VEHICLES,
-    )
-
-    # date of endpoint usage
-    today = str(datetime.now().replace(microsecond=0, second=0, minute=0, hour=0))
-    result = {today: {"route": routes, "num_vehicles": OPTIMAL_NUM_OF_VEHICLES}}
-
-    schedules = get_schedules_of_vehicles(result)
-    report = create_report_for_schedules(schedules)
-    final_report = postprocess_schedules(report).drop("день", axis=1)
-    final_report[["дата-время прибытия", "дата-время отъезда"]] = (
-        final_report[["дата-время прибытия", "дата-время отъезда"]].astype(str)
-    )
-
-    # return result as file in fixed format
-    stream = StringIO()
-    final_report.to_csv(stream, index=False)
-    response = StreamingResponse(iter([stream.getvalue()]), media_type="text/csv")
-    response.headers["Content-Disposition"] = "attachment; filename=export.csv"
-    return response
+async def find_optimal_routes(
+        stream: Literal["sse", "ndjson"] = None,
+        format: Literal["csv", "parquet", "xlsx"] = "csv",
+    ): # terminals_income: dict[int, float]
+    # with stream, client gets every better routes as soon as they are found instead of the final CSV
+    if stream is not None:
+        return await stream_routes_response(stream)
+
+    job = submit_routes_job()
+    # wait for the solver without blocking event loop
+    if job.future is not None:
+        with metrics.span("wait_routes"):
+            try:
+                await asyncio.wrap_future(job.future)
+            except Exception:
+                pass
+    if job.status != DONE or job.result is None:
+        raise HTTPException(status_code=500, detail=job.error or "Routes are not found")
+    return await job_report_response(job, format)
+
+
+@app.post("/jobs/find_optimal_routes", status_code=202)
+async def submit_find_optimal_routes():
+    return submit_routes_job().to_dict()
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return get_job_or_404(job_id).to_dict()
+
+
+@app.get("/jobs/{job_id}/result", response_class=StreamingResponse)
+async def get_job_result(job_id: str, format: Literal["csv", "parquet", "xlsx"] = "csv"):
+    job = get_job_or_404(job_id)
+    if job.status != DONE:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}")
+    if job.result is None:
+        raise HTTPException(status_code=422, detail="Routes are not found")
+    return await job_report_response(job, format)
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    get_job_or_404(job_id)
+    return app_data["jobs"].cancel(job_id).to_dict()
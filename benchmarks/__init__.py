@@ -0,0 +1 @@
+"""Benchmarks of the pipeline on synthetic terminal networks: python -m benchmarks.run"""
@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import generate_network
+from calculate_costs import calc_daily_costs
+from find_terminals_to_cash_out import find_terminals_to_cash_out
+from get_routes import ROUTING_PROFILES, estimate_min_num_vehicles, return_optimal_route
+from prepare_data import build_data_context
+from report_writer import write_report
+from schedule_report import create_schedules_report, get_schedules_of_vehicles
+
+DEFAULT_SIZES = (250, 500, 1000, 1630)
+DEFAULT_NUM_DAYS = 30
+# stage is a regression if it is this times slower than in the compared run
+REGRESSION_RATIO = 1.5
+# stages faster than this are too noisy to compare
+MIN_COMPARED_SECONDS = 0.05
+
+
+def sweep_routes(terminals: list[int], terminals_coords: pd.DataFrame, num_vehicles: int) -> list[list[int]]:
+    """
+    Return cheap routes to feed stages after the solver: terminals are split into sectors by angle around center,
+    and every sector is visited from center to its border.
+    """
+    coords = terminals_coords.set_index("TID").loc[terminals, ["longitude", "latitude"]].values
+    offsets = coords - coords.mean(axis=0)
+    angles = np.arctan2(offsets[:, 1], offsets[:, 0])
+    radiuses = np.hypot(offsets[:, 0], offsets[:, 1])
+    sectors = np.array_split(np.argsort(angles, kind="stable"), num_vehicles)
+    return [np.asarray(terminals)[sector[np.argsort(radiuses[sector])]].tolist() for sector in sectors]
+
+
+def measure(fn, repeat: int = 1) -> tuple[dict, object]:
+    """Return best time of fn over repeat runs (or error) and the last result."""
+    times, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            return {"seconds": None, "error": repr(e)}, None
+        times.append(time.perf_counter() - start)
+    return {"seconds": min(times)}, result
+
+
+def run_size(
+        num_terminals: int,
+        num_days: int,
+        seed: int,
+        income_distribution: str = "lognormal",
+        repeat: int = 3,
+        routing_profile: str = "default",
+    ) -> dict:
+    """Generate network of num_terminals for num_days and time every stage of the pipeline on it."""
+    stages = {}
+    stages["generate"], (incomes, times, terminals_coords) = measure(
+        lambda: generate_network(num_terminals, num_days, seed, income_distribution)
+    )
+
+    stages["prepare_data"], ctx = measure(lambda: build_data_context(incomes, times, terminals_coords), repeat)
+    stages["find_terminals_to_cash_out"], day_terminals = measure(lambda: find_terminals_to_cash_out(ctx), repeat)
+    if day_terminals is None:
+        return {"num_terminals": num_terminals, "num_days": num_days, "stages": stages}
+
+    # solver is run once for the first day, other days get cheap routes
+    first_day, first_day_terminals = next(iter(day_terminals.items()))
+    num_vehicles = estimate_min_num_vehicles(ctx.distance_matrix, first_day_terminals, ctx.tid_2_idx) + 1
+    stages["return_optimal_route"], first_day_routes = measure(lambda: return_optimal_route(
+        ctx.distance_matrix, first_day_terminals, ctx.tid_2_idx, ctx.idx_2_tid, num_vehicles,
+        config=ROUTING_PROFILES[routing_profile],
+    ))
+    stages["return_optimal_route"]["num_vehicles"] = num_vehicles
+    stages["return_optimal_route"]["num_terminals"] = len(first_day_terminals)
+    # cheap routes are worse than solver ones, so they get more vehicles
+    routes = {
+        day: {"route": sweep_routes(terminals, terminals_coords, 2 * num_vehicles), "num_vehicles": 2 * num_vehicles}
+        for day, terminals in day_terminals.items()
+    }
+    if first_day_routes is not None:
+        routes[first_day]["route"] = first_day_routes
+
+    stages["get_schedules_of_vehicles"], _ = measure(lambda: get_schedules_of_vehicles(routes, ctx), repeat)
+    stages["create_schedules_report"], report = measure(lambda: create_schedules_report(routes, ctx), repeat)
+    stages["calc_daily_costs"], costs = measure(lambda: calc_daily_costs(routes, ctx), repeat)
+
+    if costs is not None:
+        collection, funding, curr_sum = costs
+        sheets = {
+            "остатки на конец дня": (curr_sum, True),
+            "стоимость фондирования": (funding, True),
+            "стоимость инкассации": (collection, True),
+            "маршруты": (report, False),
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stages["excel_export"], _ = measure(lambda: write_report(os.path.join(tmp_dir, "report.xlsx"), sheets))
+
+    return {"num_terminals": num_terminals, "num_days": num_days, "stages": stages}
+
+
+def environment() -> dict:
+    import ortools
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "ortools": ortools.__version__,
+    }
+
+
+def compare(results: dict, baseline: dict, ratio: float = REGRESSION_RATIO) -> list[str]:
+    """Print time of every stage against baseline results and return found regressions."""
+    baseline_runs = {(run["num_terminals"], run["num_days"]): run for run in baseline["runs"]}
+    regressions = []
+    for run in results["runs"]:
+        baseline_run = baseline_runs.get((run["num_terminals"], run["num_days"]))
+        if baseline_run is None:
+            continue
+        for stage, timing in run["stages"].items():
+            old_seconds = baseline_run["stages"].get(stage, {}).get("seconds")
+            seconds = timing.get("seconds")
+            if old_seconds is None or seconds is None:
+                continue
+            print(f"{run['num_terminals']:>6} {stage:<28} {old_seconds:>9.3f}s -> {seconds:>9.3f}s ({seconds / old_seconds:.2f}x)")
+            if seconds > ratio * old_seconds and seconds > MIN_COMPARED_SECONDS:
+                regressions.append(f"{stage} on {run['num_terminals']} terminals: {old_seconds:.3f}s -> {seconds:.3f}s")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time every stage of the pipeline on synthetic networks of different sizes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="numbers of terminals")
+    parser.add_argument("--days", type=int, default=DEFAULT_NUM_DAYS, help="number of days")
+    parser.add_argument("--seed", type=int, default=2023)
+    parser.add_argument("--income", choices=["lognormal", "gamma", "poisson"], default="lognormal")
+    parser.add_argument("--repeat", type=int, default=3, help="best of repeat runs is taken for fast stages")
+    parser.add_argument("--profile", choices=list(ROUTING_PROFILES), default="default", help="settings of routes search")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file with results")
+    parser.add_argument("--compare", default=None, help="JSON file of previous run, exit with 1 if some stage is slower")
+    args = parser.parse_args()
+
+    results = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "environment": environment(),
+        "params": {
+            "days": args.days, "seed": args.seed, "income": args.income, "repeat": args.repeat, "profile": args.profile,
+        },
+        "runs": [],
+    }
+    for num_terminals in args.sizes:
+        run = run_size(num_terminals, args.days, args.seed, args.income, args.repeat, args.profile)
+        results["runs"].append(run)
+        for stage, timing in run["stages"].items():
+            print(f"{num_terminals:>6} {stage:<28} {timing['seconds'] or 0:>9.3f}s {timing.get('error', '')}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f))
+        if regressions:
+            print("Regressions:", *regressions, sep="\n")
+            sys.exit(1)
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+
+from prepare_data import INITIAL_BALANCE_COLUMN, haversine_matrix
+
+# terminals are spread over a box around Moscow as in the real data
+LONGITUDE_RANGE = (37.35, 37.85)
+LATITUDE_RANGE = (55.57, 55.92)
+# travel time model: straight line distance with detour factor at average city speed plus parking
+SPEED_KM_PER_MIN = 0.5
+DETOUR_FACTOR = 1.3
+PARKING_TIME = 2
+# first planning day, the day before is initial balance
+START_DATE = "2022-09-01"
+
+
+def generate_coords(num_terminals: int, rng: np.random.Generator, num_districts: int = 12) -> pd.DataFrame:
+    """Return TIDS sheet: terminals grouped around random district centers."""
+    tids = np.sort(rng.choice(np.arange(400_000, 700_000), size=num_terminals, replace=False))
+    centers = np.column_stack([rng.uniform(*LONGITUDE_RANGE, num_districts), rng.uniform(*LATITUDE_RANGE, num_districts)])
+    districts = rng.integers(0, num_districts, num_terminals)
+    coords = centers[districts] + rng.normal(0, 0.04, (num_terminals, 2)) * [1.8, 1]
+    coords[:, 0] = coords[:, 0].clip(*LONGITUDE_RANGE)
+    coords[:, 1] = coords[:, 1].clip(*LATITUDE_RANGE)
+    return pd.DataFrame({"TID": tids, "longitude": coords[:, 0], "latitude": coords[:, 1]})
+
+
+def generate_times(terminals_coords: pd.DataFrame, rng: np.random.Generator) -> pd.DataFrame:
+    """Return times sheet: travel time in minutes for every ordered pair of different terminals."""
+    distance = haversine_matrix(terminals_coords["latitude"].values, terminals_coords["longitude"].values)
+    # traffic makes times asymmetric
+    times = distance * DETOUR_FACTOR / SPEED_KM_PER_MIN * rng.uniform(0.9, 1.2, distance.shape) + PARKING_TIME
+
+    num_terminals = len(terminals_coords)
+    origin, destination = np.nonzero(~np.eye(num_terminals, dtype=bool))
+    tids = terminals_coords["TID"].values
+    return pd.DataFrame({
+        "Origin_tid": tids[origin],
+        "Destination_tid": tids[destination],
+        "Total_Time": times[origin, destination].round(2),
+    })
+
+
+def generate_incomes(
+        tids: np.ndarray,
+        num_days: int,
+        rng: np.random.Generator,
+        income_distribution: str = "lognormal",
+        mean_income: float = 56_000,
+    ) -> pd.DataFrame:
+    """
+    Return Incomes sheet: TID, initial balance and income of every day rounded to thousands.
+    Every terminal has its own mean income, daily incomes are drawn around it from income_distribution.
+    """
+    num_terminals = len(tids)
+    terminal_means = mean_income * rng.lognormal(-0.18, 0.6, num_terminals)
+    if income_distribution == "lognormal":
+        incomes = terminal_means[:, None] * rng.lognormal(-0.08, 0.4, (num_terminals, num_days))
+    elif income_distribution == "gamma":
+        incomes = rng.gamma(4, terminal_means[:, None] / 4, (num_terminals, num_days))
+    elif income_distribution == "poisson":
+        incomes = rng.poisson(terminal_means[:, None] / 1000, (num_terminals, num_days)) * 1000
+    else:
+        raise ValueError(f"Unknown income distribution {income_distribution}")
+    # some terminals don't work some days
+    incomes[rng.random(incomes.shape) < 0.03] = 0
+    incomes = (incomes / 1000).round().astype(np.int64) * 1000
+    initial_balance = (terminal_means * rng.uniform(0, 5, num_terminals) / 1000).round().astype(np.int64) * 1000
+
+    days = pd.date_range(START_DATE, periods=num_days, freq="D").astype(str).map(lambda day: f"{day} 00:00:00")
+    return pd.concat([
+        pd.DataFrame({"TID": tids, INITIAL_BALANCE_COLUMN: initial_balance}),
+        pd.DataFrame(incomes, columns=days),
+    ], axis=1)
+
+
+def generate_network(
+        num_terminals: int,
+        num_days: int,
+        seed: int = 2023,
+        income_distribution: str = "lognormal",
+    ) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Return synthetic incomes, times and terminals coordinates in the same shape as prepare_data.read_data."""
+    rng = np.random.default_rng(seed)
+    terminals_coords = generate_coords(num_terminals, rng)
+    times = generate_times(terminals_coords, rng)
+    incomes = generate_incomes(terminals_coords["TID"].values, num_days, rng, income_distribution)
+    return incomes, times, terminals_coords
@@ -1,13 +1,22 @@
+import numpy as np
 import pandas as pd
+from dataclasses import dataclass, field
 from itertools import chain
-from find_terminals_to_cash_out import ARMORED_CAR_PRICE, incassation_price, PCT
-from prepare_data import prepare_data
+from find_terminals_to_cash_out import ARMORED_CAR_PRICE, INCASSATION_MIN, INCASSATION_PCT, PCT
+from income_store import IncomeStore
+from metrics import timed
+from prepare_data import DataContext, get_cash_matrix, load_data_context
 
 
 def flatten_list(x: list[list[int]]) -> list[int]:
     return list(chain(*x))
 
 
+def incassation_price_array(amount: np.ndarray) -> np.ndarray:
+    """Vectorized version of incassation_price."""
+    return np.maximum(INCASSATION_MIN, INCASSATION_PCT * amount)
+
+
 def find_daily_vehicles_cost(routes_with_num_vehiles: dict[str, dict]) -> int:
     """Return vehicles cost for a day."""
     max_num_vehicles = 0
@@ -18,55 +27,146 @@ def find_daily_vehicles_cost(routes_with_num_vehiles: dict[str, dict]) -> int:
     return ARMORED_CAR_PRICE * max_num_vehicles
 
 
-def calc_daily_costs(routes_with_num_vehiles) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    """Calculate collection and funding costs + remaining cash in terminal."""
+def build_collection_mask(routes_with_num_vehiles: dict, tids: np.ndarray, days: pd.DatetimeIndex) -> np.ndarray:
+    """Return (terminal x day) boolean mask of collections, tids must be sorted."""
+    was_collection = np.zeros((len(tids), len(days)), dtype=bool)
+    day_2_pos = {day: pos for pos, day in enumerate(days.strftime("%Y-%m-%d"))}
+    for day, v in routes_with_num_vehiles.items():
+        day_pos = day_2_pos.get(day.split()[0])
+        collected = np.asarray(flatten_list(v["route"]), dtype=tids.dtype)
+        if day_pos is None or len(collected) == 0:
+            continue
+        tid_pos = np.minimum(np.searchsorted(tids, collected), len(tids) - 1)
+        # unknown terminals are skipped, as merge with incomes does it
+        tid_pos = tid_pos[tids[tid_pos] == collected]
+        was_collection[tid_pos, day_pos] = True
+    return was_collection
+
+
+def calc_costs_arrays(cash: np.ndarray, was_collection: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Calculate collection and funding costs + remaining cash for dense (terminal x day) arrays.
+    First day is initial balance, so results are returned for days starting from the second one.
+    """
+    num_days = cash.shape[1]
+    day_idx = np.arange(num_days)
+    # there is no collection for initial balance
+    was_collection = was_collection.copy()
+    was_collection[:, 0] = False
+
+    # cash in terminal at the end of the day is accumulated from the last collection day (including it)
+    # or from the initial balance, so it is a segmented cumulative sum
+    segment_start = np.maximum.accumulate(np.where(was_collection, day_idx, 0), axis=1)
+    cumsum = np.cumsum(cash, axis=1)
+    cumsum_before = np.hstack([np.zeros((cash.shape[0], 1), dtype=cumsum.dtype), cumsum[:, :-1]])
+    balance = cumsum - np.take_along_axis(cumsum_before, segment_start, axis=1)
+
+    # costs of the day depend on cash amount at the end of previous day
+    prev_balance = balance[:, :-1]
+    collected = was_collection[:, 1:]
+    collection = np.where(collected, incassation_price_array(prev_balance), 0.)  # price of incassation
+    funding = np.where(collected, 0., PCT * prev_balance)  # price of percents
+    cur_sum = np.where(collected, 0., prev_balance)
+    return collection, funding, cur_sum
+
+
+@dataclass
+class CostAccumulator:
+    """
+    Costs of planning days, which are added one by one when a day is advanced, so history is never rescanned.
+    Fleet is as big as the most vehicles of a day so far and it is paid every day from the day it is needed.
+    """
+    days: list[str] = field(default_factory=list)
+    funding: list[float] = field(default_factory=list)
+    collection: list[float] = field(default_factory=list)
+    vehicles: list[float] = field(default_factory=list)
+    fleet_size: int = 0
+
+    def add_day(self, day: str, balances: np.ndarray, was_collection: np.ndarray, num_vehicles: int) -> dict:
+        """
+        Add costs of the day: balances are cash in terminals at the end of previous day,
+        was_collection is mask of terminals collected on the day. Same rules as calc_costs_arrays, O(terminals).
+        """
+        self.fleet_size = max(self.fleet_size, num_vehicles)
+        self.days.append(day)
+        self.collection.append(float(incassation_price_array(balances[was_collection]).sum()))
+        self.funding.append(float(PCT * balances[~was_collection].sum()))
+        self.vehicles.append(float(ARMORED_CAR_PRICE * self.fleet_size))
+        return self.report()[-1]
+
+    def report(self) -> list[dict]:
+        """Return costs of every day and cumulative total cost."""
+        total = np.cumsum(np.add(np.add(self.funding, self.collection), self.vehicles)).tolist()
+        return [
+            {
+                "day": day,
+                "funding": funding,
+                "collection": collection,
+                "vehicles": vehicles,
+                "total": funding + collection + vehicles,
+                "cumulative_total": cumulative_total,
+            }
+            for day, funding, collection, vehicles, cumulative_total in zip(
+                self.days, self.funding, self.collection, self.vehicles, total
+            )
+        ]
+
+    def totals(self) -> dict:
+        funding, collection, vehicles = sum(self.funding), sum(self.collection), sum(self.vehicles)
+        return {
+            "funding": funding,
+            "collection": collection,
+            "vehicles": vehicles,
+            "total": funding + collection + vehicles,
+            "num_days": len(self.days),
+        }
+
+    def to_state(self) -> dict:
+        """Return arrays to save costs with PoiStats state."""
+        return {
+            "costs_days": np.asarray(self.days, dtype=str),
+            "costs_funding": np.asarray(self.funding, dtype=float),
+            "costs_collection": np.asarray(self.collection, dtype=float),
+            "costs_vehicles": np.asarray(self.vehicles, dtype=float),
+            "costs_fleet_size": self.fleet_size,
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "CostAccumulator":
+        """Restore costs from to_state result, state without costs gives empty costs."""
+        if "costs_days" not in state:
+            return cls()
+        return cls(
+            days=np.asarray(state["costs_days"]).tolist(),
+            funding=np.asarray(state["costs_funding"]).tolist(),
+            collection=np.asarray(state["costs_collection"]).tolist(),
+            vehicles=np.asarray(state["costs_vehicles"]).tolist(),
+            fleet_size=int(state["costs_fleet_size"]),
+        )
+
+
+@timed("calc_daily_costs")
+def calc_daily_costs(
+        routes_with_num_vehiles,
+        ctx: DataContext = None,
+        income_store: IncomeStore = None,
+    ) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Calculate collection and funding costs + remaining cash in terminal.
+    With income_store, cash is read from it up to the last day of routes instead of the Incomes sheet.
+    """
     # prepare initial data
-    incomes, _ = prepare_data()
-    incomes = incomes.sort_values(["timestamp", "TID"])
-    incomes["timestamp"] = incomes["timestamp"].astype(str)
+    if income_store is not None:
+        tids, days, cash = income_store.cash_matrix(end=max(routes_with_num_vehiles, default=None))
+    else:
+        ctx = ctx or load_data_context()
+        tids, days, cash = get_cash_matrix(ctx)
 
     # get top-k terminals for every day
-    day_terminals = {day.split()[0]: flatten_list(v["route"]) for day, v in routes_with_num_vehiles.items()}
-    collection_schedule = pd.DataFrame(day_terminals.items(), columns=["timestamp", "TID"]).explode("TID")
-
-    # get daily incomes
-    incomes = (
-        incomes
-        .merge(collection_schedule.assign(was_collection=1), on=["TID", "timestamp"], how="left")
-        .fillna(0)
-    )
-
-    results = []
-    # going by points and add spents
-    for terminal in incomes["TID"].unique():
-        curr_sum = 0
-        for i, (_, row) in enumerate(incomes.query(f"TID == {terminal}").iterrows()):
-            if i == 0:
-                curr_sum = row["cash"]
-            else:
-                new_row = {"TID": terminal, "timestamp": row["timestamp"]}
-                if row["was_collection"]:
-                    new_row["funding"] = 0
-                    new_row["cur_sum"] = 0
-                    new_row["collection"] = incassation_price(curr_sum) # price of incassation (depends of money amount)
-                    curr_sum = row["cash"] # only amount of cash for day, because money was taken by auto
-                else:
-                    new_row["funding"] = PCT * curr_sum # price of percents
-                    new_row["collection"] = 0
-                    new_row["cur_sum"] = curr_sum
-                    curr_sum += row["cash"]
-                results.append(pd.DataFrame(new_row, index=[0]))
-    results = pd.concat(results).reset_index(drop=True)
-
-    # get total spents
-    collection = results.drop(["funding", "cur_sum"], axis=1).pivot_table(index="TID", columns="timestamp")
-    funding = results.drop(["collection", "cur_sum"], axis=1).pivot_table(index="TID", columns="timestamp")
-    curr_sum = results.drop(["funding", "collection"], axis=1).pivot_table(index="TID", columns="timestamp")
+    was_collection = build_collection_mask(routes_with_num_vehiles, tids, days)
+    collection, funding, curr_sum = calc_costs_arrays(cash, was_collection)
 
     # get overall dataframe
-    for df in (collection, funding, curr_sum):
-        df.columns = df.columns.droplevel(0)
-        df.columns.name = ''
-        df.index.name = "Устройство"
-
-    return collection, funding, curr_sum
+    index = pd.Index(tids, name="Устройство")
+    columns = pd.Index(days[1:].strftime("%Y-%m-%d"), name='')
+    return tuple(pd.DataFrame(values, index=index, columns=columns) for values in (collection, funding, curr_sum))
@@ -1,9 +1,14 @@
+import argparse
+import json
 import pandas as pd
-from get_routes import find_optimal_routes_with_iterating_num_vehicles
+import metrics
+from get_routes import MIN_NUM_VEHICLES, ROUTING_PROFILES, find_optimal_routes_for_days
 from find_terminals_to_cash_out import find_terminals_to_cash_out
-from prepare_data import create_distance_matrix, get_mappings, prepare_data
-from schedule_report import create_report_for_schedules, get_schedules_of_vehicles, postprocess_schedules
+from income_store import IncomeStore
+from prepare_data import load_data_context
+from schedule_report import create_schedules_report
 from calculate_costs import calc_daily_costs, find_daily_vehicles_cost
+from report_writer import REPORT_FORMATS, write_report
 
 
 def make_overall_sheet(funding: pd.DataFrame, collection: pd.DataFrame):
@@ -33,50 +38,93 @@ def make_overall_sheet(funding: pd.DataFrame, collection: pd.DataFrame):
 
 
 if __name__ == "__main__":
-    # look for terminals that we want to be in incassation
-    day_terminals_to_cash_out = find_terminals_to_cash_out()
-
-    # load initial data
-    incomes, times = prepare_data()
-    # get terminal indexes mapping
-    tid_2_idx, idx_2_tid = get_mappings()
-    times["Destination_tid_idx"] = times["Destination_tid"].map(tid_2_idx)
+    parser = argparse.ArgumentParser(description="Create report with optimal routes of armored vehicles.")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes to solve days (default: all CPUs)")
+    parser.add_argument(
+        "--search", choices=["linear", "galloping"], default="linear",
+        help="how to search for the number of vehicles of a day (galloping is faster, linear is the reference run)",
+    )
+    parser.add_argument(
+        "--profile", choices=list(ROUTING_PROFILES), default="default", help="settings of routes search",
+    )
+    parser.add_argument(
+        "--warm-start", action="store_true", help="start routes search of a day from routes of the previous day",
+    )
+    parser.add_argument(
+        "--max-cluster-size", type=int, default=None,
+        help="split terminals of a day into spatial clusters of this size and solve them in parallel",
+    )
+    parser.add_argument(
+        "--format", choices=REPORT_FORMATS, default="xlsx",
+        help="format of report: xlsx file or directory with csv/parquet file per sheet",
+    )
+    parser.add_argument("--output", default=None, help="path of report (default: report.xlsx or report/)")
+    parser.add_argument("--timings", default=None, help="path of file to save time of every stage")
+    parser.add_argument(
+        "--params", default=None, help="JSON file with cash_weight and num_terminals found by tune_params.py",
+    )
+    parser.add_argument(
+        "--income-store", default=None, help="directory of incomes store made by income_store.py instead of Incomes sheet",
+    )
+    args = parser.parse_args()
 
-    # load distance matrix
-    distance_matrix = create_distance_matrix()
+    # load initial data once: incomes, times, terminal indexes mapping and distance matrix
+    ctx = load_data_context()
 
-    routes = {}
-    max_num_vehicles = 0
+    # look for terminals that we want to be in incassation
+    params = {}
+    if args.params is not None:
+        with open(args.params, encoding="utf-8") as f:
+            params = json.load(f)
+    income_store = IncomeStore(args.income_store) if args.income_store is not None else None
+    day_terminals_to_cash_out = find_terminals_to_cash_out(
+        ctx, **{name: params[name] for name in ("cash_weight", "num_terminals") if name in params},
+        income_store=income_store,
+    )
 
     # going day by day and getting number of vehicles and daily routes
-    for day, terminals in day_terminals_to_cash_out.items():
-        # generate routes and number of vehicles
-        route, num_vehicles = find_optimal_routes_with_iterating_num_vehicles(
-            distance_matrix=distance_matrix,
-            terminals_to_cash_out=terminals,
-            tid_2_idx=tid_2_idx,
-            idx_2_tid=idx_2_tid,
-            min_num_vehicles=8,
-            max_num_vehicles=len(terminals) // 4 + 1,
-        )
-        max_num_vehicles = max(max_num_vehicles, num_vehicles)
-        routes[day] = {"route": route, "num_vehicles": max_num_vehicles}
+    # days are independent, so they are solved in parallel
+    routes = find_optimal_routes_for_days(
+        day_terminals_to_cash_out,
+        distance_matrix=ctx.distance_matrix_path or ctx.distance_matrix,
+        tid_2_idx=ctx.tid_2_idx,
+        idx_2_tid=ctx.idx_2_tid,
+        min_num_vehicles=MIN_NUM_VEHICLES,
+        num_workers=args.workers,
+        search=args.search,
+        config=ROUTING_PROFILES[args.profile],
+        warm_start=args.warm_start,
+        terminals_coords=ctx.terminals_coords,
+        max_cluster_size=args.max_cluster_size,
+    )
 
     # generate schedules for our aoutomobiles and routes
     # add schedules into report
-    schedules = get_schedules_of_vehicles(routes)
-    report = create_report_for_schedules(schedules)
-    final_report = postprocess_schedules(report)
-    final_report[["дата-время прибытия", "дата-время отъезда"]] = final_report[["дата-время прибытия", "дата-время отъезда"]].astype(str)
+    # routes respect working hours already, so schedules need no fixes
+    final_report = create_schedules_report(routes, ctx).drop("день", axis=1)
+    if args.format == "xlsx":
+        final_report[["дата-время прибытия", "дата-время отъезда"]] = final_report[["дата-время прибытия", "дата-время отъезда"]].astype(str)
 
     # calculate costs
-    collection, funding, curr_sum = calc_daily_costs(routes)
+    collection, funding, curr_sum = calc_daily_costs(routes, ctx, income_store)
     overall = make_overall_sheet(funding, collection)
 
-    # save resutl file
-    with pd.ExcelWriter("report.xlsx", date_format="YYYY-MM-DD HH:MM") as writer:
-        curr_sum.to_excel(writer, sheet_name="остатки на конец дня")
-        funding.to_excel(writer, sheet_name="стоимость фондирования")
-        collection.to_excel(writer, sheet_name="стоимость инкассации")
-        final_report.drop("день", axis=1).to_excel(writer, sheet_name="маршруты", index=False)
-        overall.to_excel(writer, sheet_name="итог", index=False)
+    # save resutl file, sheets are written by chunks of rows
+    write_report(
+        args.output or ("report.xlsx" if args.format == "xlsx" else "report"),
+        {
+            "остатки на конец дня": (curr_sum, True),
+            "стоимость фондирования": (funding, True),
+            "стоимость инкассации": (collection, True),
+            "маршруты": (final_report, False),
+            "итог": (overall, False),
+        },
+        report_format=args.format,
+    )
+
+    # time of every stage of the run, solver stages are collected from worker processes
+    summary = metrics.REGISTRY.summary()
+    print(summary)
+    if args.timings is not None:
+        with open(args.timings, "w", encoding="utf-8") as f:
+            f.write(summary + "\n")
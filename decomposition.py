@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+
+from prepare_data import submatrix
+
+
+def partition_terminals(
+        terminals: list[int],
+        terminals_coords: pd.DataFrame,
+        num_vehicles: int,
+        max_cluster_size: int,
+    ) -> list[tuple[list[int], int]]:
+    """
+    Split terminals into spatial clusters and share vehicles between them: return (terminals, num_vehicles) of clusters.
+    Recursive coordinate bisection: terminals are split by the wider side of their bounding box,
+    and sizes of both parts are proportional to their vehicles, until a cluster is not bigger than max_cluster_size.
+    """
+    coords = terminals_coords.set_index("TID").loc[terminals, ["longitude", "latitude"]].to_numpy()
+    # degree of longitude is shorter than degree of latitude
+    coords[:, 0] *= np.cos(np.radians(coords[:, 1].mean()))
+    num_vehicles = max(num_vehicles, -(-len(terminals) // max_cluster_size))
+
+    clusters = []
+    stack = [(np.arange(len(terminals)), num_vehicles)]
+    while stack:
+        positions, vehicles = stack.pop()
+        if len(positions) <= max_cluster_size or vehicles <= 1:
+            # terminals keep their order of the day, routes start and end in pseudo depo as for the whole day
+            clusters.append(([terminals[i] for i in np.sort(positions)], vehicles))
+            continue
+        axis = np.ptp(coords[positions], axis=0).argmax()
+        positions = positions[np.argsort(coords[positions, axis], kind="stable")]
+        left_vehicles = vehicles // 2
+        cut = round(len(positions) * left_vehicles / vehicles)
+        stack.append((positions[cut:], vehicles - left_vehicles))
+        stack.append((positions[:cut], left_vehicles))
+    return clusters
+
+
+def _path_time(route: list[int], distance_matrix: np.ndarray) -> int:
+    return int(sum(distance_matrix[a, b] for a, b in zip(route[:-1], route[1:])))
+
+
+def _best_insertion(route: list[int], node: int, distance_matrix: np.ndarray) -> tuple[int, int]:
+    """Return (extra time, position) of the cheapest insertion of node into open path."""
+    if not route:
+        return 0, 0
+    costs = [distance_matrix[node, route[0]]]
+    costs += [
+        distance_matrix[a, node] + distance_matrix[node, b] - distance_matrix[a, b]
+        for a, b in zip(route[:-1], route[1:])
+    ]
+    costs.append(distance_matrix[route[-1], node])
+    position = int(np.argmin(costs))
+    return int(costs[position]), position
+
+
+def improve_boundaries(
+        routes: list[list[int]],
+        route_clusters: list[int],
+        distance_matrix: np.ndarray,
+        tid_2_idx: dict[int, int],
+        idx_2_tid: dict[int, int],
+        capacity: int,
+        num_neighbours: int = 5,
+        max_passes: int = 3,
+    ) -> list[list[int]]:
+    """
+    Move terminals between routes of neighbouring clusters while it makes total time smaller.
+    Only boundary terminals (some of num_neighbours nearest terminals is in another cluster) are tried,
+    and only to routes of these neighbours, route time can't be more than capacity.
+    """
+    nodes = [tid_2_idx[tid] for route in routes for tid in route]
+    if len(nodes) < 2:
+        return routes
+    # day matrix: positions of terminals in nodes instead of terminal indices
+    day_matrix = submatrix(distance_matrix, nodes)
+    position = {node: i for i, node in enumerate(nodes)}
+    routes = [[position[tid_2_idx[tid]] for tid in route] for route in routes]
+    route_of = np.array([r for r, route in enumerate(routes) for _ in route])
+    cluster_of = np.array(route_clusters)[route_of]
+    times = [_path_time(route, day_matrix) for route in routes]
+
+    num_neighbours = min(num_neighbours, len(nodes) - 1)
+    distances = day_matrix.astype(float) + np.diag(np.full(len(nodes), np.inf))
+    neighbours = np.argpartition(distances, num_neighbours - 1, axis=1)[:, :num_neighbours]
+    boundary = np.flatnonzero((cluster_of[neighbours] != cluster_of[:, None]).any(axis=1))
+
+    for _ in range(max_passes):
+        improved = False
+        for node in boundary:
+            source = route_of[node]
+            route = routes[source]
+            i = route.index(node)
+            without = route[:i] + route[i + 1:]
+            gain = times[source] - _path_time(without, day_matrix)
+
+            best = None
+            for target in set(route_of[neighbours[node]].tolist()) - {source}:
+                if route_clusters[target] == route_clusters[source]:
+                    continue
+                extra, insert_at = _best_insertion(routes[target], node, day_matrix)
+                if times[target] + extra <= capacity and extra < gain and (best is None or extra < best[0]):
+                    best = (extra, target, insert_at)
+            if best is None:
+                continue
+
+            extra, target, insert_at = best
+            routes[source] = without
+            times[source] -= gain
+            routes[target].insert(insert_at, node)
+            times[target] += extra
+            route_of[node] = target
+            improved = True
+        if not improved:
+            break
+    return [[idx_2_tid[nodes[i]] for i in route] for route in routes]
@@ -1,8 +1,9 @@
 import pandas as pd
 import numpy as np
-# import optuna
 
-from prepare_data import read_data
+from income_store import IncomeStore
+from metrics import timed
+from prepare_data import INITIAL_BALANCE_DATE, DataContext, load_data_context
 
 # Initial constants from specification
 PCT = (2/100/365)
@@ -44,141 +45,229 @@ def estimate_waiting_days(amt_history):
     pass
 
 
+def top_k_positions(scores: np.ndarray, k: int) -> np.ndarray:
+    """Return positions of k largest scores sorted by score descending (ties are sorted by position)."""
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    if k >= len(scores):
+        top = np.arange(len(scores))
+    else:
+        # O(n) selection instead of full sort
+        top = np.argpartition(-scores, k - 1)[:k]
+        # elements equal to the k-th score are taken by position to be same as stable sorting
+        threshold = scores[top].min()
+        above = np.flatnonzero(scores > threshold)
+        on_threshold = np.flatnonzero(scores == threshold)[:k - len(above)]
+        top = np.sort(np.concatenate([above, on_threshold]))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
 class PoiStats():
     """Counting poi statistics class."""
-    
+
     def __init__(self, sum_dict, top_k=100, start_date=None, weights=(0.5, 0.5)):
         if start_date is None:
             raise ValueError('start_date must be non empty')
         else:
             self.start_date = pd.to_datetime(start_date)
-        
+
         # we save date in class to print it while we debug (if there is some troubles)
         # we save sate for every date, summaries and number of total top_k points in daily routes
         self._state_date = self.start_date
-        self.sum_dict = sum_dict
-        self.state_dict = {elem: 0 for elem in sum_dict.keys()}
+        # sum_dict is TID -> cash amount dict or pd.Series with TID index
+        # all states are arrays aligned with terminals positions in self.tids
+        if isinstance(sum_dict, pd.Series):
+            self.tids = sum_dict.index.values
+            self.balances = sum_dict.values.copy()
+        else:
+            self.tids = np.array(list(sum_dict.keys()))
+            self.balances = np.array(list(sum_dict.values()))
+        self._tid_2_pos = {tid: pos for pos, tid in enumerate(self.tids.tolist())}
+        self.downtime = np.zeros(len(self.tids), dtype=np.int64)
+        self.scores = np.zeros(len(self.tids))
         self.top_k = top_k
-        
+
         # required - we need this point tommorrow
         # optional - we can visit this points, but it is not necessary
         # daily - total top_k points for some day T
         self._required_list = []
         self._optional_list = []
         self._daily_list = []
-        
+        self._required_mask = np.zeros(len(self.tids), dtype=bool)
+        self._daily_mask = np.zeros(len(self.tids), dtype=bool)
+
         # number of business rules violations
         # and w_1, w_2 points from target function
         self._n_violations = 0
         self._weights = weights
-    
+
+    @property
+    def sum_dict(self) -> dict:
+        return dict(zip(self.tids.tolist(), self.balances.tolist()))
+
+    @property
+    def state_dict(self) -> dict:
+        return dict(zip(self.tids.tolist(), self.downtime.tolist()))
+
+    def to_state(self) -> dict:
+        """Return all state as arrays and numbers, e.g. to save it with np.savez."""
+        return {
+            "tids": self.tids,
+            "balances": self.balances,
+            "downtime": self.downtime,
+            "scores": self.scores,
+            "top_k": self.top_k,
+            "weights": np.asarray(self._weights, dtype=float),
+            "start_date": str(self.start_date),
+            "state_date": str(self._state_date),
+            "n_violations": self._n_violations,
+            "required_list": np.asarray(self._required_list, dtype=self.tids.dtype),
+            "optional_list": np.asarray(self._optional_list, dtype=self.tids.dtype),
+            "daily_list": np.asarray(self._daily_list, dtype=self.tids.dtype),
+            "required_mask": self._required_mask,
+            "daily_mask": self._daily_mask,
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "PoiStats":
+        """Restore PoiStats from to_state result without replaying days."""
+        stat_obj = cls(
+            pd.Series(np.asarray(state["balances"]), index=np.asarray(state["tids"])),
+            int(state["top_k"]),
+            start_date=str(state["start_date"]),
+            weights=tuple(np.asarray(state["weights"]).tolist()),
+        )
+        stat_obj._state_date = pd.to_datetime(str(state["state_date"]))
+        stat_obj.downtime = np.array(state["downtime"])
+        stat_obj.scores = np.array(state["scores"])
+        stat_obj._n_violations = int(state["n_violations"])
+        stat_obj._required_list = np.asarray(state["required_list"]).tolist()
+        stat_obj._optional_list = np.asarray(state["optional_list"]).tolist()
+        stat_obj._daily_list = np.asarray(state["daily_list"]).tolist()
+        stat_obj._required_mask = np.array(state["required_mask"])
+        stat_obj._daily_mask = np.array(state["daily_mask"])
+        return stat_obj
+
+    def _to_array(self, day_sum_dict) -> np.ndarray:
+        """Align daily cash (array, pd.Series or dict) with terminals positions."""
+        if isinstance(day_sum_dict, np.ndarray):
+            return day_sum_dict
+        if isinstance(day_sum_dict, pd.Series):
+            return day_sum_dict.reindex(self.tids).values
+        return np.array([day_sum_dict[tid] for tid in self.tids.tolist()])
+
+    @timed("update_day")
     def update_day(self, day_sum_dict, daily_list=None):
         """Function to get incassation points for every day."""
         if daily_list is None:
             self._daily_list = self._get_required_poi() + self._get_optional_poi()
         else:
             self._daily_list = daily_list
-        
+            self._daily_mask = np.zeros(len(self.tids), dtype=bool)
+            self._daily_mask[[self._tid_2_pos[tid] for tid in daily_list if tid in self._tid_2_pos]] = True
+
         # if point in incassation list -> we restart state counter (num of days)
         # if point in incassation list -> we restart point cash amount (with last day value)
-        for elem in self.sum_dict:
-            if elem in self._daily_list:
-                self.state_dict[elem] = 0
-                self.sum_dict[elem] = day_sum_dict[elem]
-            else:
-                self.state_dict[elem] += 1
-                self.sum_dict[elem] += day_sum_dict[elem]
+        day_sums = self._to_array(day_sum_dict)
+        self.downtime = np.where(self._daily_mask, 0, self.downtime + 1)
+        self.balances = np.where(self._daily_mask, day_sums, self.balances + day_sums)
 
         # check, if there is some business rule violations
         self._check_violations()
         self._state_date += pd.Timedelta('24 hours')
-    
+
     def _check_violations(self):
         """Function to check, if there is any rules violations."""
         # check time and money requirements violations
-        self._n_violations += len([elem for elem, val in self.state_dict.items() if val >= MAX_DOWNTIME])
+        self._n_violations += int(np.count_nonzero(self.downtime >= MAX_DOWNTIME))
         self._n_violations += max(0, len(self._required_list) - self.top_k)
-    
+
     def _get_required_poi(self):
         # add all points with >= 1 mln RUB in terminal (or another MAX_AMT)
-        self._required_list = [elem for elem, val in self.sum_dict.items() if val >= MAX_AMT]
+        self._required_mask = self.balances >= MAX_AMT
+        self._daily_mask = self._required_mask.copy()
+        self._required_list = self.tids[self._required_mask].tolist()
         return self._required_list
-        
+
     def _get_optional_poi(self):
         # normalized score is sum of normalized (between 0 and 1) daily and amount score
-        self._normalized_dict = {}
         # weights are importances of time and cash amount to sort points
-        for elem in self.sum_dict:
-            self._normalized_dict[elem] = (self._weights[0] * self.sum_dict[elem] / MAX_AMT + 
-                                          self._weights[1] * self.state_dict[elem] / MAX_DOWNTIME)
-        
+        self.scores = (self._weights[0] * self.balances / MAX_AMT +
+                       self._weights[1] * self.downtime / MAX_DOWNTIME)
+
         # if there is some space, we take into roures not only points with > 1 mln RUB cash amount
         # but some more points (with suitable timing or amount of money)
-        self._optional_list = [
-            elem for elem, _ in sorted(self._normalized_dict.items(), key=lambda x: x[1], reverse=True)
-            if elem not in self._required_list][:max(0, self.top_k - len(self._required_list))
-        ]
-        
-        return self._optional_list
-
-
-# def objective_function(trial):
-#     amt_weight = trial.suggest_float("amt_weight", 0.01, 0.99)
-#     n_points = trial.suggest_int("n_points", 90, 150)
-#     obj = 10**6
-
-#     stat_obj = PoiStats(
-#         cash_ts[DAYS[0]].to_dict(),
-#         n_points,
-#         start_date='2022-08-31 00:00:00', 
-#         weights=(amt_weight, 1 - amt_weight)
-#     )
+        candidates = np.flatnonzero(~self._required_mask)
+        optional = candidates[top_k_positions(
+            self.scores[candidates], max(0, self.top_k - len(self._required_list))
+        )]
+        self._daily_mask[optional] = True
+        self._optional_list = self.tids[optional].tolist()
 
-#     for day in DAYS[1:]:
-#         stat_obj.update_day(cash_ts[day].to_dict())
-
-#     step_obj = int(stat_obj._n_violations > 0) * 10**5 + n_points
-
-#     if obj > step_obj:
-#         obj = step_obj
-
-#     return obj
-
-def find_terminals_to_cash_out() -> dict[str, list[int]]:
-    """Find terminals that satisfy conditions to be cashed out for every day."""
-    # read data
-    cash_ts, _, _ = read_data()
-    cash_ts.index = cash_ts['TID']
-
-    days = cash_ts.columns[1:]
-
-    # if we want to get new best parameters, we need to uncomment code below
+        return self._optional_list
 
-    # study = optuna.create_study(sampler=optuna.samplers.TPESampler(seed=2023))
-    # study.optimize(objective_function, n_trials=100)
-    # print(study.best_params, study.best_value)
 
-    # These are founded by optuna best parameters
-    # best_amt_weight - importance of time and money charasteristics
-    # best_value - number of collection points per day 
+def replay_season(
+        cash: np.ndarray,
+        tids: np.ndarray,
+        top_k: int,
+        cash_weight: float,
+        start_date: str = INITIAL_BALANCE_DATE,
+    ) -> tuple[int, np.ndarray]:
+    """
+    Run PoiStats over (terminal x day) cash matrix, the first day is initial balance.
+    Return number of violations and (terminal x day) mask of collections.
+    """
+    stat_obj = PoiStats(pd.Series(cash[:, 0], index=tids), top_k, start_date=start_date, weights=(cash_weight, 1 - cash_weight))
+    was_collection = np.zeros(cash.shape, dtype=bool)
+    for day in range(1, cash.shape[1]):
+        stat_obj.update_day(cash[:, day])
+        was_collection[:, day] = stat_obj._daily_mask
+    return stat_obj._n_violations, was_collection
+
+
+@timed("find_terminals_to_cash_out")
+def find_terminals_to_cash_out(
+        ctx: DataContext = None,
+        cash_weight: float = BEST_CASH_WEIGHT,
+        num_terminals: int = BEST_NUM_OF_TERMINALS_TO_CASH_OUT,
+        income_store: IncomeStore = None,
+    ) -> dict[str, list[int]]:
+    """
+    Find terminals that satisfy conditions to be cashed out for every day.
+    Default parameters are found by tune_params.py: cash_weight is importance of cash against downtime,
+    num_terminals is number of collected terminals per day.
+    With income_store, incomes are read from it day by day instead of the Incomes sheet.
+    """
+    if income_store is not None:
+        days = income_store.days_between()
+        initial_balance = pd.Series(income_store.day(days[0]), index=income_store.tids)
+        day_incomes = ((pd.Timestamp(day).strftime("%Y-%m-%d %H:%M:%S"), income_store.day(day)) for day in days[1:])
+    else:
+        # read data
+        ctx = ctx or load_data_context()
+        cash_ts = ctx.cash_ts.set_index(ctx.cash_ts['TID'])
+        days = cash_ts.columns[1:]
+        initial_balance = cash_ts[days[0]]
+        day_incomes = ((day, cash_ts[day].values) for day in days[1:])
 
     stat_obj = PoiStats(
-        cash_ts[days[0]].to_dict(),
-        BEST_NUM_OF_TERMINALS_TO_CASH_OUT,
-        start_date='2022-08-31 00:00:00', 
-        weights=(BEST_CASH_WEIGHT, 1 - BEST_CASH_WEIGHT)
+        initial_balance,
+        num_terminals,
+        start_date=INITIAL_BALANCE_DATE,
+        weights=(cash_weight, 1 - cash_weight)
     )
 
     day_required_terminals = {}
     
     # we are going day by day from initial data
-    for day in days[1:]:
+    for day, incomes in day_incomes:
         # update states for every day
-        stat_obj.update_day(cash_ts[day].to_dict())
+        stat_obj.update_day(incomes)
         # get our daily terminal to go by in some day
         day_required_terminals[day] = stat_obj._daily_list
         # if there is money rule violation - throw error
-        if BEST_NUM_OF_TERMINALS_TO_CASH_OUT < len(stat_obj._required_list):
+        if num_terminals < len(stat_obj._required_list):
             raise NameError("There is no parameters without 1 mln RUB rule violation")
 
     return day_required_terminals
@@ -1,6 +1,104 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from itertools import chain
+
 import numpy as np
-from ortools.constraint_solver import routing_enums_pb2
-from ortools.constraint_solver import pywrapcp
+import pandas as pd
+
+import metrics
+from decomposition import improve_boundaries, partition_terminals
+from find_terminals_to_cash_out import STOP_TIME
+from prepare_data import open_distance_matrix, submatrix
+
+# working hours of vehicles in minutes from midnight
+WORKDAY_START = 8 * 60
+WORKDAY_END = 20 * 60
+MINUTES_IN_DAY = 24 * 60
+# sum of distance matrix times of a route (they include stop in the terminal of arrival),
+# minus 10 minutes because first point takes 10 minutes and 10 minutes to leave the last one before the end of the day
+VEHICLE_TIME_CAPACITY = WORKDAY_END - WORKDAY_START - 2 * STOP_TIME
+# fleet of batch planning is never smaller than this
+MIN_NUM_VEHICLES = 8
+
+
+@dataclass(frozen=True)
+class TimeWindows:
+    """
+    Time model of a day in minutes from midnight, which is used by the solver and by schedules.
+    Vehicle v starts at the first minute of its shift (vehicle_shifts[v] or shift) and must leave its last terminal before
+    the end of the shift, terminal is served for service_times[TID] (STOP_TIME by default) minutes,
+    and service must be inside of terminal_windows[TID] if it is given, vehicle waits if it arrives earlier.
+    Travel time is time of distance matrix without STOP_TIME which is included in it.
+    """
+    shift: tuple[int, int] = (WORKDAY_START, WORKDAY_END)
+    vehicle_shifts: tuple[tuple[int, int], ...] = ()
+    service_times: dict[int, int] = None
+    terminal_windows: dict[int, tuple[int, int]] = None
+
+    def vehicle_shift(self, vehicle_id: int) -> tuple[int, int]:
+        return self.vehicle_shifts[vehicle_id] if vehicle_id < len(self.vehicle_shifts) else self.shift
+
+    def service_time(self, tids: np.ndarray) -> np.ndarray:
+        service_times = np.full(len(tids), STOP_TIME, dtype=np.int64)
+        if self.service_times:
+            service_times[:] = [self.service_times.get(tid, STOP_TIME) for tid in np.asarray(tids).tolist()]
+        return service_times
+
+    def windows(self, tids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Return the first minute of service and the minute service must be finished by for every terminal."""
+        opens = np.zeros(len(tids), dtype=np.int64)
+        closes = np.full(len(tids), MINUTES_IN_DAY, dtype=np.int64)
+        if self.terminal_windows:
+            for i, tid in enumerate(np.asarray(tids).tolist()):
+                opens[i], closes[i] = self.terminal_windows.get(tid, (0, MINUTES_IN_DAY))
+        return opens, closes
+
+
+DEFAULT_TIME_WINDOWS = TimeWindows()
+
+
+@dataclass(frozen=True)
+class RoutingConfig:
+    """Settings of OR-tools search, strategies are names from routing_enums_pb2."""
+    first_solution_strategy: str = "AUTOMATIC"
+    local_search_metaheuristic: str = "AUTOMATIC"
+    time_limit: int = 60  # seconds
+    solution_limit: int = None  # stop after this number of found solutions
+    global_span_cost_coefficient: int = 5
+
+    def search_parameters(self):
+        """Return OR-tools search parameters."""
+        from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+
+        search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+        search_parameters.first_solution_strategy = getattr(
+            routing_enums_pb2.FirstSolutionStrategy, self.first_solution_strategy
+        )
+        search_parameters.local_search_metaheuristic = getattr(
+            routing_enums_pb2.LocalSearchMetaheuristic, self.local_search_metaheuristic
+        )
+        search_parameters.time_limit.seconds = self.time_limit
+        if self.solution_limit is not None:
+            search_parameters.solution_limit = self.solution_limit
+        return search_parameters
+
+
+# "fast" is for API: good enough routes in several seconds, "thorough" is for batch reports
+ROUTING_PROFILES = {
+    "default": RoutingConfig(),
+    "fast": RoutingConfig(
+        first_solution_strategy="PATH_CHEAPEST_ARC",
+        local_search_metaheuristic="GUIDED_LOCAL_SEARCH",
+        time_limit=5,
+    ),
+    "thorough": RoutingConfig(
+        first_solution_strategy="PARALLEL_CHEAPEST_INSERTION",
+        local_search_metaheuristic="GUIDED_LOCAL_SEARCH",
+        time_limit=120,
+    ),
+}
 
 
 def create_data_for_solver(distance_matrix: np.ndarray, num_vehicles: int = 1, depot: int = 0):
@@ -13,7 +111,11 @@ def create_data_for_solver(distance_matrix: np.ndarray, num_vehicles: int = 1, d
 
 
 def get_routes(solution, routing, manager, data) -> list[list[int]]:
-    """Get vehicles routes from a solution and store them in an array."""
+    """
+    Get vehicles routes from a solution and store them in an array.
+    If solution is None, routes are taken from the current solution of running search (in solution callback).
+    Routes start from pseudo depo, which is skipped later with other nodes out of terminals.
+    """
     routes = []  # List to store routes for each vehicle
     for vehicle_id in range(data['num_vehicles']):
         route = []
@@ -21,9 +123,8 @@ def get_routes(solution, routing, manager, data) -> list[list[int]]:
         while not routing.IsEnd(index):
             node_index = manager.IndexToNode(index)
             route.append(node_index)
-            index = solution.Value(routing.NextVar(index))
-        # We store point zero only for 1 vehicle because other vehicles starts from another points
-        routes.append(route) if vehicle_id == 0 else routes.append(route[1:])
+            index = solution.Value(routing.NextVar(index)) if solution else routing.NextVar(index).Value()
+        routes.append(route)
     return routes
 
 
@@ -47,71 +148,223 @@ def print_solution(data, manager, routing, solution):
     print('Maximum of the route distances: {}m'.format(max_route_distance))
 
 
-def return_optimal_route(
+def select_distance_matrix(
         distance_matrix: np.ndarray,
         terminals_to_cash_out: list[int],
         tid_2_idx: dict[int, int],
-        idx_2_tid: dict[int, int],
-        num_vehicles: int = 1,
-    ) -> list[list[int]]:
-    """Returns optimal routes."""
+    ) -> tuple[list[int], np.ndarray]:
+    """Return indices of terminals and their distance matrix with pseudo depo as the last node."""
     selected_indices = [tid_2_idx[i] for i in terminals_to_cash_out]
     num_terminals = len(selected_indices)
-    distance_matrix_selected = distance_matrix[selected_indices][:, selected_indices]
+    distance_matrix_selected = submatrix(distance_matrix, selected_indices)
 
     # To let the solver choose start and end points of the routes instead of depo every time
     distance_matrix_selected = np.insert(distance_matrix_selected, num_terminals, 0, axis=0)
     distance_matrix_selected = np.insert(distance_matrix_selected, num_terminals, 0, axis=1)
+    return selected_indices, distance_matrix_selected
+
+
+def estimate_min_num_vehicles(
+        distance_matrix: np.ndarray,
+        terminals_to_cash_out: list[int],
+        tid_2_idx: dict[int, int],
+        time_windows: TimeWindows = DEFAULT_TIME_WINDOWS,
+    ) -> int:
+    """
+    Return lower bound of number of vehicles with time model of time_windows.
+    Every terminal is served and reached by some arc, which is not shorter than the shortest travel to it,
+    except the first terminals of routes (arcs from pseudo depo are free, but only one terminal can follow it
+    in every route), and total time of all routes can't be more than total shifts of vehicles (they end a minute before shift end).
+    Waiting for opening of terminals only makes routes longer, so windows are not needed for the bound.
+    """
+    selected_indices = [tid_2_idx[i] for i in terminals_to_cash_out]
+    if len(selected_indices) < 2:
+        return 1
+    distance_matrix_selected = submatrix(distance_matrix, selected_indices, dtype=float)
+    travel_times = np.maximum(distance_matrix_selected - STOP_TIME, 0)
+    np.fill_diagonal(travel_times, np.inf)
+    min_arrival_times = np.sort(travel_times.min(axis=0))[::-1]
+    service_time = time_windows.service_time(np.asarray(terminals_to_cash_out, dtype=np.int64)).sum()
+    # with n vehicles, n longest arrivals can be free, and vehicles 0..n-1 work their shifts
+    num_vehicles = np.arange(1, len(min_arrival_times) + 1)
+    shifts = np.cumsum([end - 1 - start for start, end in map(time_windows.vehicle_shift, range(len(num_vehicles)))])
+    enough = shifts >= service_time + min_arrival_times.sum() - np.cumsum(min_arrival_times)
+    return int(num_vehicles[enough.argmax()]) if enough.any() else len(num_vehicles)
+
+
+def _fit_routes_to_vehicles(routes: list[list[int]], num_vehicles: int) -> list[list[int]]:
+    """Merge the shortest routes or add empty ones to get exactly num_vehicles routes."""
+    routes = [list(route) for route in routes]
+    while len(routes) > num_vehicles:
+        routes.sort(key=len)
+        routes = [routes[0] + routes[1]] + routes[2:]
+    return routes + [[] for _ in range(num_vehicles - len(routes))]
+
+
+@metrics.timed("return_optimal_route")
+def return_optimal_route(
+        distance_matrix: np.ndarray,
+        terminals_to_cash_out: list[int],
+        tid_2_idx: dict[int, int],
+        idx_2_tid: dict[int, int],
+        num_vehicles: int = 1,
+        initial_routes: list[list[int]] = None,
+        config: RoutingConfig = ROUTING_PROFILES["default"],
+        solution_callback=None,
+        time_windows: TimeWindows = DEFAULT_TIME_WINDOWS,
+    ) -> list[list[int]]:
+    """
+    Returns optimal routes.
+    Every vehicle starts and ends in pseudo depo, so the solver chooses the first and the last terminals,
+    and routes respect working hours, service times and terminal windows of time_windows.
+    initial_routes (TIDs of every vehicle, e.g. routes of the previous day) are used as a start solution:
+    terminals which are not in terminals_to_cash_out are dropped and new ones are inserted in the cheapest
+    positions. If such routes are not feasible, the solver starts from scratch.
+    solution_callback(routes, objective) is called every time the solver finds better routes,
+    if it returns True, the search is stopped and the best found routes are returned.
+    """
+    # OR-tools is imported on first solve, so the API process starts without it
+    from ortools.constraint_solver import pywrapcp
+
+    selected_indices, distance_matrix_selected = select_distance_matrix(
+        distance_matrix, terminals_to_cash_out, tid_2_idx
+    )
+    num_terminals = len(selected_indices)
 
-    data = create_data_for_solver(distance_matrix_selected, num_vehicles)
+    data = create_data_for_solver(distance_matrix_selected, num_vehicles, depot=num_terminals)
 
     # Create the routing index manager.
     manager = pywrapcp.RoutingIndexManager(
         len(data['distance_matrix']),
         data['num_vehicles'],
-        data['depot'],
+        [data['depot']] * data['num_vehicles'],
+        [data['depot']] * data['num_vehicles'],
     )
     routing = pywrapcp.RoutingModel(manager)
 
-    def distance_callback(from_index, to_index):
-        """Returns the distance between the two nodes."""
-        # Convert from routing variable Index to distance matrix NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return data['distance_matrix'][from_node][to_node]
-
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+    # Matrix is passed to the solver as is, so it doesn't call python for every arc
+    transit_callback_index = routing.RegisterTransitMatrix(data['distance_matrix'].tolist())
 
     # Define cost of each arc.
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
+    # time of arc is service in the origin and travel to the destination, cumul of a terminal is start of its service
+    tids = np.array([idx_2_tid[idx] for idx in selected_indices], dtype=np.int64)
+    service_times = np.append(time_windows.service_time(tids), 0)
+    travel_times = np.maximum(distance_matrix_selected - STOP_TIME, 0)
+    travel_times[:, num_terminals] = 0
+    time_callback_index = routing.RegisterTransitMatrix((travel_times + service_times[:, None]).tolist())
+
     dimension_name = 'Time'
     routing.AddDimension(
-        transit_callback_index,
-        slack_max=0,  # no slack
-        capacity=12 * 60 - 20,  # vehicle maximum travel time, minus 10 minutes because first point takes 10 minutes
-        fix_start_cumul_to_zero=False,  # start cumul to zero
+        time_callback_index,
+        # vehicle waits only for opening of terminals
+        slack_max=MINUTES_IN_DAY if time_windows.terminal_windows else 0,
+        capacity=MINUTES_IN_DAY,
+        fix_start_cumul_to_zero=False,
         name=dimension_name,
     )
     time_dimension = routing.GetDimensionOrDie(dimension_name)
-    time_dimension.SetGlobalSpanCostCoefficient(5)
+    time_dimension.SetGlobalSpanCostCoefficient(config.global_span_cost_coefficient)
+    opens, closes = time_windows.windows(tids)
+    for node in np.flatnonzero((opens > 0) | (closes < MINUTES_IN_DAY)).tolist():
+        time_dimension.CumulVar(manager.NodeToIndex(node)).SetRange(
+            int(opens[node]), int(closes[node] - service_times[node])
+        )
+    for vehicle_id in range(num_vehicles):
+        shift_start, shift_end = time_windows.vehicle_shift(vehicle_id)
+        time_dimension.CumulVar(routing.Start(vehicle_id)).SetValue(shift_start)
+        # the last terminal must be left before the end of the shift, departure at 20:00 is already late
+        time_dimension.CumulVar(routing.End(vehicle_id)).SetMax(shift_end - 1)
 
-    # Setting first solution heuristic.
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.AUTOMATIC
-    search_parameters.time_limit.seconds = 60
+    # Setting first solution heuristic, local search and limits.
+    search_parameters = config.search_parameters()
 
-    solution = routing.SolveWithParameters(search_parameters)
+    def to_tids(routes: list[list[int]]) -> list[list[int]]:
+        # Every route starts from pseudo depo created in select_distance_matrix
+        return [
+            [idx_2_tid[selected_indices[i]] for i in route if i < num_terminals]
+            for route in routes
+        ]
+
+    if solution_callback is not None:
+        best_objective = [None]
+
+        def on_solution():
+            objective = routing.CostVar().Max()
+            if best_objective[0] is not None and objective >= best_objective[0]:
+                return
+            best_objective[0] = objective
+            if solution_callback(to_tids(get_routes(None, routing, manager, data)), objective):
+                routing.solver().FinishCurrentSearch()
+
+        routing.AddAtSolutionCallback(on_solution)
+
+    initial_assignment = None
+    if initial_routes:
+        routing.CloseModelWithParameters(search_parameters)
+        initial_assignment = routing.ReadAssignmentFromRoutes(
+            _routes_to_nodes(initial_routes, selected_indices, tid_2_idx, num_vehicles, distance_matrix_selected), True
+        )
+
+    if initial_assignment:
+        solution = routing.SolveFromAssignmentWithParameters(initial_assignment, search_parameters)
+    else:
+        solution = routing.SolveWithParameters(search_parameters)
+    metrics.record_solver_stats(
+        status=routing.status(),
+        objective=solution.ObjectiveValue() if solution else None,
+        branches=routing.solver().Branches(),
+        failures=routing.solver().Failures(),
+        wall_seconds=routing.solver().WallTime() / 1000,
+    )
     if solution:
         # print_solution(data, manager, routing, solution)
         routes = get_routes(solution, routing, manager, data)
+        return to_tids(routes)
 
-        # Last terminal in every route is pseudo depo created on lines 65-66
-        routes_tids = [
-            [idx_2_tid[selected_indices[i]] for i in route if i < num_terminals]
-            for route in routes
-        ]
-        return routes_tids
+
+def _insert_nodes(routes: list[list[int]], nodes: list[int], distance_matrix: np.ndarray) -> list[list[int]]:
+    """Insert nodes one by one into the cheapest position of routes, all routes start and end in pseudo depo."""
+    depot = len(distance_matrix) - 1
+    for node in nodes:
+        best_insertion = None
+        for vehicle_id, route in enumerate(routes):
+            path = np.array([depot] + route + [depot])
+            route_time = distance_matrix[path[:-1], path[1:]].sum()
+            deltas = (
+                distance_matrix[path[:-1], node] + distance_matrix[node, path[1:]]
+                - distance_matrix[path[:-1], path[1:]]
+            )
+            position = int(deltas.argmin())
+            # routes which stay within vehicle capacity are preferred
+            insertion = (route_time + deltas[position] > VEHICLE_TIME_CAPACITY, deltas[position], vehicle_id, position)
+            if best_insertion is None or insertion < best_insertion:
+                best_insertion = insertion
+        _, _, vehicle_id, position = best_insertion
+        routes[vehicle_id].insert(position, node)
+    return routes
+
+
+def _routes_to_nodes(
+        routes: list[list[int]],
+        selected_indices: list[int],
+        tid_2_idx: dict[int, int],
+        num_vehicles: int,
+        distance_matrix_selected: np.ndarray,
+    ) -> list[list[int]]:
+    """Convert routes of TIDs into routes of solver nodes (without pseudo depo) which visit all terminals."""
+    idx_2_node = {idx: node for node, idx in enumerate(selected_indices)}
+    nodes_routes = []
+    for route in routes:
+        nodes = [idx_2_node.get(tid_2_idx.get(tid)) for tid in route]
+        # terminals not from the list are skipped
+        nodes_routes.append([node for node in nodes if node is not None])
+    routes = _fit_routes_to_vehicles(nodes_routes, num_vehicles)
+
+    visited = set(chain(*routes))
+    new_nodes = [node for node in range(len(selected_indices)) if node not in visited]
+    return _insert_nodes(routes, new_nodes, distance_matrix_selected)
 
 
 def find_optimal_routes_with_iterating_num_vehicles(
@@ -121,10 +374,298 @@ def find_optimal_routes_with_iterating_num_vehicles(
         idx_2_tid: dict[int, int],
         min_num_vehicles: int = 1,
         max_num_vehicles: int = 5,
+        search: str = "linear",
+        config: RoutingConfig = ROUTING_PROFILES["default"],
+        initial_routes: list[list[int]] = None,
+        time_windows: TimeWindows = DEFAULT_TIME_WINDOWS,
     ) -> tuple[list[list[int]], int]:
-    """Find an optimal number of vehicles to solve the problem and returns optimal routes with num_vehicles."""
-    for num_vehicles in range(min_num_vehicles, max_num_vehicles + 1):
-        routes = return_optimal_route(distance_matrix, terminals_to_cash_out, tid_2_idx, idx_2_tid, num_vehicles)
+    """
+    Find an optimal number of vehicles to solve the problem and returns optimal routes with num_vehicles.
+    search="linear" tries every number of vehicles from min_num_vehicles,
+    search="galloping" starts from lower bound of number of vehicles, doubles the step until routes are found
+    and then makes bisection between the last failed and found numbers of vehicles.
+    initial_routes (e.g. routes of the previous day) are a start solution until some routes are found.
+    """
+    if search == "linear":
+        for num_vehicles in range(min_num_vehicles, max_num_vehicles + 1):
+            routes = return_optimal_route(
+                distance_matrix, terminals_to_cash_out, tid_2_idx, idx_2_tid, num_vehicles,
+                initial_routes=initial_routes, config=config, time_windows=time_windows,
+            )
+            if routes:
+                return routes, num_vehicles
+        return None, None
+    if search != "galloping":
+        raise ValueError(f"Unknown search: {search}")
+
+    min_num_vehicles = max(
+        min_num_vehicles,
+        estimate_min_num_vehicles(distance_matrix, terminals_to_cash_out, tid_2_idx, time_windows),
+    )
+    if min_num_vehicles > max_num_vehicles:
+        return None, None
+
+    # galloping: min, min + 1, min + 3, min + 7, ... until the first feasible number of vehicles
+    best_routes, best_num_vehicles = None, None
+    num_vehicles, step = min_num_vehicles, 1
+    while best_routes is None:
+        routes = return_optimal_route(
+            distance_matrix, terminals_to_cash_out, tid_2_idx, idx_2_tid, num_vehicles,
+            initial_routes=initial_routes, config=config, time_windows=time_windows,
+        )
         if routes:
-            return routes, num_vehicles
-    return None, None
+            best_routes, best_num_vehicles = routes, num_vehicles
+        elif num_vehicles == max_num_vehicles:
+            return None, None
+        else:
+            min_num_vehicles = num_vehicles + 1
+            num_vehicles, step = min(max_num_vehicles, num_vehicles + step), step * 2
+
+    # bisection: routes of the best found solution are a start solution for smaller number of vehicles
+    while min_num_vehicles < best_num_vehicles:
+        num_vehicles = (min_num_vehicles + best_num_vehicles) // 2
+        routes = return_optimal_route(
+            distance_matrix, terminals_to_cash_out, tid_2_idx, idx_2_tid, num_vehicles,
+            initial_routes=best_routes, config=config, time_windows=time_windows,
+        )
+        if routes:
+            best_routes, best_num_vehicles = routes, num_vehicles
+        else:
+            min_num_vehicles = num_vehicles + 1
+    return best_routes, best_num_vehicles
+
+
+# data shared by all days of planning horizon, it is sent to every worker process only once
+_worker_data = {}
+
+
+def init_worker(
+        distance_matrix: np.ndarray | str,
+        tid_2_idx: dict[int, int],
+        idx_2_tid: dict[int, int],
+        time_windows: TimeWindows = DEFAULT_TIME_WINDOWS,
+    ):
+    """
+    Save data for routes search in a worker process.
+    distance_matrix can be a path of npy file, then it is memory-mapped and shared by all workers.
+    """
+    if isinstance(distance_matrix, str):
+        distance_matrix = open_distance_matrix(distance_matrix)
+    _worker_data["distance_matrix"] = distance_matrix
+    _worker_data["tid_2_idx"] = tid_2_idx
+    _worker_data["idx_2_tid"] = idx_2_tid
+    _worker_data["time_windows"] = time_windows
+
+
+def return_optimal_route_in_worker(
+        terminals_to_cash_out: list[int],
+        num_vehicles: int = 1,
+        initial_routes: list[list[int]] = None,
+        config: RoutingConfig = ROUTING_PROFILES["default"],
+        solutions_queue=None,
+        stop_event=None,
+        with_metrics: bool = False,
+    ) -> list[list[int]]:
+    """
+    Return optimal routes in a worker process initialized by init_worker.
+    Better routes found during the search are put into solutions_queue (multiprocessing queue),
+    and the search is stopped when stop_event is set.
+    With with_metrics, (routes, metrics snapshot of the search) is returned to merge metrics into the parent process.
+    """
+    start = time.perf_counter()
+
+    def _on_solution(routes: list[list[int]], objective: int) -> bool:
+        if solutions_queue is not None:
+            solutions_queue.put({"routes": routes, "objective": objective, "elapsed": time.perf_counter() - start})
+        return stop_event is not None and stop_event.is_set()
+
+    solution_callback = _on_solution if solutions_queue is not None or stop_event is not None else None
+
+    with metrics.collect() as collected:
+        routes = return_optimal_route(
+            distance_matrix=_worker_data["distance_matrix"],
+            terminals_to_cash_out=terminals_to_cash_out,
+            tid_2_idx=_worker_data["tid_2_idx"],
+            idx_2_tid=_worker_data["idx_2_tid"],
+            num_vehicles=num_vehicles,
+            initial_routes=initial_routes,
+            config=config,
+            solution_callback=solution_callback,
+            time_windows=_worker_data["time_windows"],
+        )
+    if with_metrics:
+        return routes, collected.snapshot()
+    return routes
+
+
+def _solve_days(
+        days: list[tuple[str, list[int]]],
+        min_num_vehicles: int,
+        search: str,
+        config: RoutingConfig,
+        warm_start: bool,
+    ) -> tuple[list[tuple], dict]:
+    """
+    Solve consecutive days, routes of a day are a start solution for the next one if warm_start is True.
+    Return solved days and metrics snapshot of the search.
+    """
+    results = []
+    previous_routes = None
+    with metrics.collect() as collected:
+        for day, terminals in days:
+            results.append(_solve_day(day, terminals, min_num_vehicles, search, config, previous_routes))
+            previous_routes = results[-1][1] if warm_start else None
+    return results, collected.snapshot()
+
+
+def _solve_day(
+        day: str,
+        terminals: list[int],
+        min_num_vehicles: int,
+        search: str,
+        config: RoutingConfig,
+        initial_routes: list[list[int]],
+    ) -> tuple:
+    start = time.perf_counter()
+    with metrics.span("solve_day"):
+        route, num_vehicles = find_optimal_routes_with_iterating_num_vehicles(
+            distance_matrix=_worker_data["distance_matrix"],
+            terminals_to_cash_out=terminals,
+            tid_2_idx=_worker_data["tid_2_idx"],
+            idx_2_tid=_worker_data["idx_2_tid"],
+            min_num_vehicles=min_num_vehicles,
+            # a cluster may get more vehicles than its size suggests, its share is tried anyway
+            max_num_vehicles=max(len(terminals) // 4 + 1, min_num_vehicles),
+            search=search,
+            config=config,
+            initial_routes=initial_routes,
+            time_windows=_worker_data["time_windows"],
+        )
+    return day, route, num_vehicles, time.perf_counter() - start
+
+
+def _join_clusters(
+        solved_clusters: dict[tuple, tuple],
+        distance_matrix: np.ndarray,
+        tid_2_idx: dict[int, int],
+        idx_2_tid: dict[int, int],
+        improve: bool = True,
+    ) -> dict[str, tuple]:
+    """
+    Join routes of clusters of every day and improve them on the borders of clusters.
+    Borders are improved by travel times only, so with custom time windows (improve=False) routes are just joined.
+    """
+    days = {}
+    for (day, cluster), (route, num_vehicles, solve_time) in solved_clusters.items():
+        days.setdefault(day, []).append((cluster, route, num_vehicles, solve_time))
+
+    solved = {}
+    for day, clusters in days.items():
+        if any(route is None for _, route, _, _ in clusters):
+            solved[day] = (None, None, sum(solve_time for *_, solve_time in clusters))
+            continue
+        routes = [tids for _, route, _, _ in clusters for tids in route]
+        if improve:
+            with metrics.span("improve_boundaries"):
+                routes = improve_boundaries(
+                    routes,
+                    [cluster for cluster, route, _, _ in clusters for _ in route],
+                    distance_matrix, tid_2_idx, idx_2_tid, VEHICLE_TIME_CAPACITY,
+                )
+        # solve time of a day is total time of its clusters
+        solved[day] = (routes, len(routes), sum(solve_time for *_, solve_time in clusters))
+    return solved
+
+
+def _collect_metrics(solved: tuple[list[tuple], dict]) -> list[tuple]:
+    """Merge metrics of solved days into this process and return solved days."""
+    results, snapshot = solved
+    metrics.registry().merge(snapshot)
+    return results
+
+
+@metrics.timed("find_optimal_routes_for_days")
+def find_optimal_routes_for_days(
+        day_terminals_to_cash_out: dict[str, list[int]],
+        distance_matrix: np.ndarray | str,
+        tid_2_idx: dict[int, int],
+        idx_2_tid: dict[int, int],
+        min_num_vehicles: int = MIN_NUM_VEHICLES,
+        num_workers: int = None,
+        search: str = "linear",
+        config: RoutingConfig = ROUTING_PROFILES["default"],
+        warm_start: bool = False,
+        verbose: bool = True,
+        terminals_coords: pd.DataFrame = None,
+        max_cluster_size: int = None,
+        time_windows: TimeWindows = DEFAULT_TIME_WINDOWS,
+    ) -> dict[str, dict]:
+    """
+    Find routes for every day of planning horizon, days are solved in parallel processes.
+    With warm_start, horizon is split into num_workers chunks of consecutive days,
+    and every day in a chunk starts from routes of the previous day.
+    Number of vehicles of a day is the maximum over all previous days, because we can't sell vehicles.
+    distance_matrix can be a path of npy file to memory-map it in every worker instead of copying.
+    With max_cluster_size, terminals of every day are split into spatial clusters by terminals_coords,
+    clusters are solved in parallel and then terminals on the borders of clusters are moved between their routes
+    (warm_start is not used then, and neither are borders with custom time windows).
+    If routes of some days (or their clusters) are not found, ValueError with all such days is raised.
+    """
+    num_workers = num_workers or os.cpu_count()
+    days = list(day_terminals_to_cash_out.items())
+    if max_cluster_size is not None:
+        # every cluster is a separate task with (day, number of cluster) instead of day
+        matrix = open_distance_matrix(distance_matrix) if isinstance(distance_matrix, str) else distance_matrix
+        clusters = {}
+        for day, terminals in days:
+            num_vehicles = max(min_num_vehicles, estimate_min_num_vehicles(matrix, terminals, tid_2_idx, time_windows))
+            for i, cluster in enumerate(partition_terminals(terminals, terminals_coords, num_vehicles, max_cluster_size)):
+                clusters[day, i] = cluster
+        tasks = [([(key, terminals)], num_vehicles, search, config, False) for key, (terminals, num_vehicles) in clusters.items()]
+    elif warm_start:
+        chunk_size = -(-len(days) // num_workers)
+        chunks = [days[i:i + chunk_size] for i in range(0, len(days), chunk_size)]
+        tasks = [(chunk, min_num_vehicles, search, config, warm_start) for chunk in chunks]
+    else:
+        tasks = [([day], min_num_vehicles, search, config, warm_start) for day in days]
+
+    # progress is counted by solved days (or clusters), a task of warm start has several days
+    num_solved = sum(len(task[0]) for task in tasks)
+    solved = {}
+    if num_workers == 1:
+        init_worker(distance_matrix, tid_2_idx, idx_2_tid, time_windows)
+        results = (result for task in tasks for result in _collect_metrics(_solve_days(*task)))
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=min(num_workers, len(tasks)) or 1,
+            initializer=init_worker,
+            initargs=(distance_matrix, tid_2_idx, idx_2_tid, time_windows),
+        )
+        futures = [executor.submit(_solve_days, *task) for task in tasks]
+        results = (result for future in as_completed(futures) for result in _collect_metrics(future.result()))
+
+    try:
+        for i, (day, route, num_vehicles, solve_time) in enumerate(results, 1):
+            solved[day] = (route, num_vehicles, solve_time)
+            if verbose:
+                print(f"[{i}/{num_solved}] {day}: {num_vehicles} vehicles, {solve_time:.1f} s")
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if max_cluster_size is not None:
+        solved = _join_clusters(solved, matrix, tid_2_idx, idx_2_tid, time_windows == DEFAULT_TIME_WINDOWS)
+
+    unsolved = [day for day in day_terminals_to_cash_out if solved[day][0] is None]
+    if unsolved:
+        raise ValueError(f"No routes are found for days {', '.join(map(str, unsolved))}")
+
+    # going day by day and getting number of vehicles and daily routes
+    routes = {}
+    max_num_vehicles = 0
+    for day in day_terminals_to_cash_out:
+        route, num_vehicles, solve_time = solved[day]
+        max_num_vehicles = max(max_num_vehicles, num_vehicles)
+        routes[day] = {"route": route, "num_vehicles": max_num_vehicles, "solve_time": solve_time}
+    return routes
@@ -0,0 +1,176 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from metrics import timed
+from prepare_data import _prepare_incomes
+
+INCOME_STORE_DIR = "data/income_store"
+INDEX_FILE = "index.npz"
+DAYS_DIR = "days"
+# incomes are whole rubles as in the Incomes sheet
+INCOME_DTYPE = np.int64
+DAY_FORMAT = "%Y-%m-%d"
+# columns of a feed in long format, other feeds are wide as the Incomes sheet: TID + one column per day
+FEED_COLUMNS = ("TID", "date", "income")
+
+
+def read_feed(path: str) -> pd.DataFrame:
+    """
+    Read incomes feed from CSV, xlsx or JSON lines and return it in long format: TID, date, income.
+    Feed is either long (TID, date, income) or wide as the Incomes sheet (TID, initial balance and days columns),
+    JSON lines are records of the long format.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".json"):
+        feed = pd.read_json(path, lines=True, dtype={"TID": np.int64, "date": str})
+    elif extension == ".csv":
+        feed = pd.read_csv(path)
+    elif extension in (".xlsx", ".xls"):
+        sheets = pd.ExcelFile(path).sheet_names
+        feed = pd.read_excel(path, sheet_name="Incomes" if "Incomes" in sheets else 0)
+    else:
+        raise ValueError(f"Unknown feed format {extension}, it must be csv, xlsx or jsonl")
+
+    if not set(FEED_COLUMNS).issubset(feed.columns):
+        # wide feed is melted here, it has only new days of the history
+        feed = _prepare_incomes(feed).rename(columns={"timestamp": "date", "cash": "income"})
+    feed = feed[list(FEED_COLUMNS)].copy()
+    feed["date"] = pd.to_datetime(feed["date"]).dt.normalize()
+    return feed
+
+
+class IncomeStore:
+    """
+    Incomes of terminals on disk: one npy column (income of every terminal) per day and an index of TIDs and days.
+    The first day is initial balance. A new day is a new file, so ingestion doesn't rewrite the history,
+    and day columns are memory-mapped, so readers load only days they need.
+    Rows keep order of the first ingested feed, new terminals are appended, they have no income before they appear.
+    The store is written by one ingestion process at a time, readers see index of the last finished ingestion.
+    """
+
+    def __init__(self, path: str = INCOME_STORE_DIR):
+        self.path = path
+        index_file = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_file):
+            with np.load(index_file) as index:
+                self.tids, self.days = index["tids"], index["days"]
+        else:
+            self.tids = np.empty(0, dtype=np.int64)
+            self.days = np.empty(0, dtype="datetime64[D]")
+        self._tid_rows = None
+
+    def _day_file(self, day: np.datetime64) -> str:
+        return os.path.join(self.path, DAYS_DIR, f"{day}.npy")
+
+    @property
+    def tid_rows(self) -> dict[int, int]:
+        if self._tid_rows is None:
+            self._tid_rows = {tid: row for row, tid in enumerate(self.tids.tolist())}
+        return self._tid_rows
+
+    def __contains__(self, day) -> bool:
+        day = np.datetime64(pd.Timestamp(day), "D")
+        position = np.searchsorted(self.days, day)
+        return position < len(self.days) and self.days[position] == day
+
+    def day(self, day) -> np.ndarray:
+        """Return income of every terminal of the day, days are found by binary search in the sorted index."""
+        if day not in self:
+            raise KeyError(f"Incomes of {pd.Timestamp(day):{DAY_FORMAT}} are not ingested")
+        column = np.load(self._day_file(np.datetime64(pd.Timestamp(day), "D")), mmap_mode="r")
+        if len(column) == len(self.tids):
+            return column
+        # terminals appended after the day had no income
+        return np.concatenate([column, np.zeros(len(self.tids) - len(column), dtype=INCOME_DTYPE)])
+
+    def day_for(self, day, tids: np.ndarray) -> np.ndarray:
+        """Return income of the day for tids in their order, unknown terminals have no income."""
+        rows = np.array([self.tid_rows.get(tid, -1) for tid in np.asarray(tids).tolist()], dtype=np.int64)
+        column = self.day(day)
+        return np.where(rows >= 0, column[rows], 0).astype(INCOME_DTYPE)
+
+    def days_between(self, start=None, end=None) -> np.ndarray:
+        """Return stored days from start to end inclusive."""
+        first = 0 if start is None else np.searchsorted(self.days, np.datetime64(pd.Timestamp(start), "D"))
+        last = len(self.days) if end is None else np.searchsorted(
+            self.days, np.datetime64(pd.Timestamp(end), "D"), side="right"
+        )
+        return self.days[first:last]
+
+    def cash_matrix(self, start=None, end=None) -> tuple[np.ndarray, pd.DatetimeIndex, np.ndarray]:
+        """
+        Return sorted TIDs, days from start to end and (terminal x day) cash matrix as prepare_data.get_cash_matrix,
+        only columns of these days are read.
+        """
+        days = self.days_between(start, end)
+        order = np.argsort(self.tids, kind="stable")
+        cash = np.empty((len(self.tids), len(days)), dtype=INCOME_DTYPE)
+        for i, day in enumerate(days):
+            cash[:, i] = self.day(day)[order]
+        return self.tids[order], pd.DatetimeIndex(days.astype("datetime64[ns]")), cash
+
+    @timed("ingest_incomes")
+    def append(self, feed: pd.DataFrame, overwrite: bool = False) -> list[str]:
+        """
+        Save incomes of new days of feed (TID, date, income) and return saved days.
+        Days which are already in the store are skipped, so a feed delivered twice changes nothing,
+        with overwrite they are replaced. Terminals missing in the feed of a day have no income.
+        """
+        feed = feed[list(FEED_COLUMNS)].copy()
+        feed["date"] = pd.to_datetime(feed["date"]).dt.normalize()
+        feed["day"] = feed["date"].values.astype("datetime64[D]")
+        if not overwrite:
+            feed = feed[~np.isin(feed["day"].values, self.days)]
+        if feed.empty:
+            return []
+
+        new_tids = pd.unique(feed.loc[~feed["TID"].isin(self.tids), "TID"]).astype(np.int64)
+        tids = np.concatenate([self.tids, new_tids]).astype(np.int64)
+        self.tids, self._tid_rows = tids, None
+        rows = feed["TID"].map(self.tid_rows).values
+        incomes = feed["income"].fillna(0).round().values.astype(INCOME_DTYPE)
+
+        os.makedirs(os.path.join(self.path, DAYS_DIR), exist_ok=True)
+        saved = []
+        for day, positions in feed.groupby("day").indices.items():
+            column = np.zeros(len(tids), dtype=INCOME_DTYPE)
+            column[rows[positions]] = incomes[positions]
+            day = np.datetime64(day, "D")
+            tmp_file = f"{self._day_file(day)}.{os.getpid()}.tmp"
+            with open(tmp_file, "wb") as f:
+                np.save(f, column)
+            os.replace(tmp_file, self._day_file(day))
+            saved.append(day)
+
+        # index is replaced after all day files are written, so readers never see a day without its file
+        self.days = np.union1d(self.days, np.array(saved, dtype="datetime64[D]"))
+        index_file = os.path.join(self.path, INDEX_FILE)
+        with open(f"{index_file}.tmp", "wb") as f:
+            np.savez(f, tids=self.tids, days=self.days)
+        os.replace(f"{index_file}.tmp", index_file)
+        return [str(day) for day in saved]
+
+
+def ingest(paths: list[str], store_path: str = INCOME_STORE_DIR, overwrite: bool = False) -> list[str]:
+    """Append incomes of new days of feeds to the store, return saved days."""
+    store = IncomeStore(store_path)
+    return [day for path in paths for day in store.append(read_feed(path), overwrite)]
+
+
+def open_income_store(path: str = INCOME_STORE_DIR) -> IncomeStore | None:
+    """Return store if something is ingested into it, otherwise None."""
+    store = IncomeStore(path)
+    return store if len(store.days) else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Append incomes of new days to the incomes store.")
+    parser.add_argument("feeds", nargs="+", help="CSV, xlsx or JSON lines files with incomes (long or wide format)")
+    parser.add_argument("--store", default=INCOME_STORE_DIR, help="directory of the store")
+    parser.add_argument("--overwrite", action="store_true", help="replace incomes of days which are already stored")
+    args = parser.parse_args()
+    days = ingest(args.feeds, args.store, args.overwrite)
+    print(f"{len(days)} days are saved" + (f": {days[0]} - {days[-1]}" if days else ""))
@@ -0,0 +1,159 @@
+import multiprocessing
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from threading import Lock
+
+# job statuses
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobQueueFull(Exception):
+    """There are too many jobs waiting to be solved."""
+
+
+@dataclass
+class Job:
+    """CPU-bound task solved in a separate process."""
+    id: str
+    created_at: float = field(default_factory=time.time)
+    finished_at: float = None
+    result: object = None
+    error: str = None
+    cancelled: bool = False
+    future: Future = field(default=None, repr=False)
+    # function to get result of the job from what fn returned, e.g. to take routes from (routes, metrics),
+    # it is called even if the running job is cancelled, but then its result is dropped
+    result_handler: object = field(default=None, repr=False)
+    # event (e.g. of multiprocessing manager) which is set to stop the running job
+    stop_event: object = field(default=None, repr=False)
+    # anything that caller wants to keep with the job (day of routes, rendered report, ...)
+    meta: dict = field(default_factory=dict, repr=False)
+
+    @property
+    def status(self) -> str:
+        if self.cancelled:
+            return CANCELLED
+        if self.finished_at is None:
+            return RUNNING if self.future is not None and self.future.running() else PENDING
+        return FAILED if self.error is not None else DONE
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+    @property
+    def active(self) -> bool:
+        """Job takes a place in the pool until its future is finished, even if the job is cancelled."""
+        return self.future is not None and self.finished_at is None
+
+
+class JobManager:
+    """
+    Bounded process pool for jobs: at most max_active_jobs can be pending or running,
+    and only max_finished_jobs last finished jobs are kept to get their results.
+    """
+
+    def __init__(
+            self,
+            max_workers: int = 1,
+            max_active_jobs: int = 8,
+            max_finished_jobs: int = 100,
+            initializer=None,
+            initargs=(),
+        ):
+        # spawn is used because forking of a multithreaded server process is not safe
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=initializer,
+            initargs=initargs,
+        )
+        self.max_active_jobs = max_active_jobs
+        self.max_finished_jobs = max_finished_jobs
+        self._jobs = OrderedDict()
+        self._lock = Lock()
+
+    def num_active_jobs(self) -> int:
+        return sum(job.active for job in self._jobs.values())
+
+    def submit(self, fn, *args, meta: dict = None, result_handler=None, stop_event=None, **kwargs) -> Job:
+        """
+        Submit fn(*args, **kwargs) to the pool, raise JobQueueFull if there are too many active jobs.
+        Result of the job is result_handler(result of fn) if result_handler is given.
+        stop_event is passed to fn as stop_event argument and is set when the job is cancelled.
+        """
+        if stop_event is not None:
+            kwargs["stop_event"] = stop_event
+        with self._lock:
+            if self.num_active_jobs() >= self.max_active_jobs:
+                raise JobQueueFull(f"There are already {self.max_active_jobs} active jobs")
+            job = Job(id=uuid.uuid4().hex, meta=meta or {}, result_handler=result_handler, stop_event=stop_event)
+            job.future = self._executor.submit(fn, *args, **kwargs)
+            self._jobs[job.id] = job
+            self._forget_finished_jobs()
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        return job
+
+    def add_finished(self, result, meta: dict = None) -> Job:
+        """Add already finished job, e.g. if its result is taken from cache."""
+        job = Job(id=uuid.uuid4().hex, result=result, meta=meta or {})
+        job.finished_at = job.created_at
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished_jobs()
+        return job
+
+    def _finish(self, job: Job, future: Future):
+        try:
+            if future.cancelled():
+                job.cancelled = True
+            elif future.exception() is not None:
+                job.error = repr(future.exception())
+            else:
+                # handler is called for cancelled jobs too, e.g. to merge metrics of the work already done
+                result = future.result() if job.result_handler is None else job.result_handler(future.result())
+                job.result = None if job.cancelled else result
+        except Exception as e:
+            # failed handler fails the job, otherwise it would be running forever
+            job.result, job.error = None, repr(e)
+        finally:
+            # job is finished only when its result is saved
+            job.finished_at = time.time()
+
+    def _forget_finished_jobs(self):
+        # cancelled jobs which are still running are kept, they are counted as active
+        finished = [job_id for job_id, job in self._jobs.items() if job.status not in (PENDING, RUNNING) and not job.active]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Job:
+        """Return job or None if there is no such job."""
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Job:
+        """
+        Cancel job. Pending job is removed from the queue,
+        running job is asked to stop by its stop_event, and its result is dropped.
+        """
+        job = self._jobs.get(job_id)
+        if job is not None and job.status in (PENDING, RUNNING):
+            if not job.future.cancel() and job.stop_event is not None:
+                job.stop_event.set()
+            job.cancelled = True
+            job.result = None
+        return job
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,250 @@
+import functools
+import os
+import resource
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+# upper bounds of histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, float("inf"))
+# metric name -> (type, help)
+METRICS_HELP = {
+    "pipeline_stage_seconds": ("histogram", "Time of pipeline stages."),
+    "solver_wall_seconds": ("histogram", "Wall time of OR-tools solves."),
+    "solver_solves_total": ("counter", "OR-tools solves by routing status."),
+    "solver_branches_total": ("counter", "Branches explored by OR-tools."),
+    "solver_failures_total": ("counter", "Failures (backtracks) of OR-tools."),
+    "solver_last_objective": ("gauge", "Objective of the last found routes."),
+    "process_startup_seconds": ("gauge", "Time from start of the process to ready to serve requests."),
+}
+ROUTING_STATUSES = {
+    0: "not_solved",
+    1: "success",
+    2: "partial_success",
+    3: "fail",
+    4: "fail_timeout",
+    5: "invalid",
+    6: "infeasible",
+}
+
+
+class Registry:
+    """Process-local storage of histograms, counters and gauges, which can be sent between processes as a dict."""
+
+    def __init__(self):
+        # (name, labels) -> value, labels is sorted tuple of (label, value)
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = Lock()
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "max": 0.0})
+            histogram["buckets"][next(i for i, bound in enumerate(BUCKETS) if value <= bound)] += 1
+            histogram["sum"] += value
+            histogram["max"] = max(histogram["max"], value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "histograms": {key: {**value, "buckets": list(value["buckets"])} for key, value in self._histograms.items()},
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+            }
+
+    def merge(self, snapshot: dict):
+        """Add metrics collected in another process or context."""
+        with self._lock:
+            for key, other in snapshot["histograms"].items():
+                histogram = self._histograms.setdefault(key, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "max": 0.0})
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+                histogram["sum"] += other["sum"]
+                histogram["max"] = max(histogram["max"], other["max"])
+            for key, value in snapshot["counters"].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            self._gauges.update(snapshot["gauges"])
+
+    def render(self) -> str:
+        """Return metrics in Prometheus text format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, (metric_type, help_text) in METRICS_HELP.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+            if metric_type == "histogram":
+                for (metric, labels), histogram in sorted(snapshot["histograms"].items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram["buckets"]):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+            else:
+                values = snapshot["counters"] if metric_type == "counter" else snapshot["gauges"]
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        lines += [
+            "# HELP process_resident_memory_bytes Resident memory size in bytes.",
+            "# TYPE process_resident_memory_bytes gauge",
+            f"process_resident_memory_bytes {resident_memory()}",
+            "# HELP process_max_resident_memory_bytes Peak resident memory size in bytes.",
+            "# TYPE process_max_resident_memory_bytes gauge",
+            f"process_max_resident_memory_bytes {max_resident_memory()}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Return table of spans: number of calls, total, mean and max time."""
+        lines = [f"{'stage':<32} {'calls':>6} {'total, s':>10} {'mean, s':>10} {'max, s':>10}"]
+        for (name, labels), histogram in sorted(self.snapshot()["histograms"].items()):
+            stage = dict(labels).get("stage", name)
+            count = sum(histogram["buckets"])
+            lines.append(
+                f"{stage:<32} {count:>6} {histogram['sum']:>10.3f} {histogram['sum'] / count:>10.3f} {histogram['max']:>10.3f}"
+            )
+        counters = self.snapshot()["counters"]
+        solves = {dict(labels)["status"]: count for (name, labels), count in counters.items() if name == "solver_solves_total"}
+        if solves:
+            lines.append(
+                f"solver: {solves}, branches: {counters.get(('solver_branches_total', ()), 0)}, "
+                f"failures: {counters.get(('solver_failures_total', ()), 0)}"
+            )
+        lines.append(f"peak memory: {max_resident_memory() / 2**20:.0f} MB")
+        return "\n".join(lines)
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+
+def resident_memory() -> int:
+    """Return current resident memory of the process in bytes (0 if it is unknown)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def process_uptime() -> float:
+    """Return seconds since start of the process (0 if it is unknown)."""
+    try:
+        with open("/proc/self/stat") as f:
+            # process name can have spaces, so fields are counted after it, start time is field 22 in clock ticks
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return 0.0
+    return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+
+
+def max_resident_memory() -> int:
+    """Return peak resident memory of the process in bytes."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+REGISTRY = Registry()
+_registry = ContextVar("metrics_registry", default=REGISTRY)
+# list of (stage, seconds) of the current request, if timings of the request are requested
+_trace = ContextVar("metrics_trace", default=None)
+
+
+def registry() -> Registry:
+    return _registry.get()
+
+
+@contextmanager
+def span(stage: str):
+    """Measure time of the block as a pipeline stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry().observe("pipeline_stage_seconds", elapsed, stage=stage)
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((stage, elapsed))
+
+
+def timed(stage: str):
+    """Decorator to measure every call of the function as a pipeline stage."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(stage: str, iterator):
+    """Yield from iterator and measure total time of producing its items as a pipeline stage."""
+    elapsed = 0.0
+    iterator = iter(iterator)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            elapsed += time.perf_counter() - start
+        yield item
+    registry().observe("pipeline_stage_seconds", elapsed, stage=stage)
+
+
+def record_solver_stats(status: int, objective: int = None, branches: int = 0, failures: int = 0, wall_seconds: float = 0):
+    metrics = registry()
+    metrics.inc("solver_solves_total", status=ROUTING_STATUSES.get(status, str(status)))
+    metrics.inc("solver_branches_total", branches)
+    metrics.inc("solver_failures_total", failures)
+    metrics.observe("solver_wall_seconds", wall_seconds)
+    if objective is not None:
+        metrics.set("solver_last_objective", objective)
+
+
+@contextmanager
+def collect():
+    """Collect metrics of the block into a separate registry, e.g. to send them from a worker process."""
+    token = _registry.set(Registry())
+    try:
+        yield _registry.get()
+    finally:
+        _registry.reset(token)
+
+
+@contextmanager
+def trace():
+    """Collect (stage, seconds) of all spans of the block into a list, e.g. to return timings of a request."""
+    spans = []
+    token = _trace.set(spans)
+    try:
+        yield spans
+    finally:
+        _trace.reset(token)
+
+
+def server_timing(spans: list[tuple[str, float]]) -> str:
+    """Return value of Server-Timing header for spans."""
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in spans)
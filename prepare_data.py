@@ -1,60 +1,389 @@
+import hashlib
+import os
+from dataclasses import dataclass
+
 import numpy as np
 import pandas as pd
 
+from metrics import timed
+
+INCOMES_PATH = "data/terminal_data_hackathon v4.xlsx"
+TIMES_PATH = "data/times v4.csv"
+CACHE_DIR = "data/.cache"
+# version of cache file layout, caches of other versions are not read
+CACHE_FORMAT_VERSION = 2
+
+INITIAL_BALANCE_COLUMN = "остаток на 31.08.2022 (входящий)"
+INITIAL_BALANCE_DATE = "2022-08-31 00:00:00"
+
+# times are whole minutes, so int32 is enough (uint16 can be used if all times are less than 45 days)
+DISTANCE_DTYPE = np.int32
+
+EARTH_RADIUS_KM = 6371
+# rows of estimated travel times are computed by blocks, so temporary arrays are block x terminals
+ESTIMATE_CHUNK_SIZE = 512
+
+# contexts already loaded in this process, keyed by source files fingerprint
+_loaded_contexts = {}
+
+
+@dataclass
+class DataContext:
+    """All prepared input data needed by the pipeline, loaded once and shared between modules."""
+    cash_ts: pd.DataFrame  # Incomes sheet as is: TID + one column per day
+    incomes: pd.DataFrame  # melted incomes: TID, timestamp, cash
+    times: pd.DataFrame  # Origin TID -> Destination TID times with terminal indexes
+    terminals_coords: pd.DataFrame  # TIDS sheet: TID, longitude, latitude
+    tid_2_idx: dict[int, int]
+    idx_2_tid: dict[int, int]
+    distance_matrix: np.ndarray  # read-only memory-mapped array if it is loaded from cache
+    distance_matrix_path: str = None  # file of memory-mapped distance matrix to open it in other processes
+
 
-def read_data():
-    terminals_coords = pd.read_excel("data/terminal_data_hackathon v4.xlsx", sheet_name="TIDS")
-    incomes = pd.read_excel("data/terminal_data_hackathon v4.xlsx", sheet_name="Incomes")
-    times = pd.read_csv("data/times v4.csv")
+@dataclass(frozen=True)
+class SpeedModel:
+    """Travel time by straight line distance: road is detour_factor times longer, plus fixed time to park."""
+    speed_kmh: float = 30
+    detour_factor: float = 1.3
+    fixed_minutes: float = 2
+
+    def minutes(self, distance_km: np.ndarray) -> np.ndarray:
+        return distance_km * self.detour_factor / self.speed_kmh * 60 + self.fixed_minutes
+
+
+def read_data(incomes_path: str = INCOMES_PATH, times_path: str = TIMES_PATH):
+    """Read source files, if times_path is None, all travel times are estimated by coordinates."""
+    terminals_coords = pd.read_excel(incomes_path, sheet_name="TIDS")
+    incomes = pd.read_excel(incomes_path, sheet_name="Incomes")
+    if times_path is None:
+        times = pd.DataFrame({
+            "Origin_tid": pd.Series(dtype=np.int64),
+            "Destination_tid": pd.Series(dtype=np.int64),
+            "Total_Time": pd.Series(dtype=float),
+        })
+    else:
+        times = pd.read_csv(times_path)
     return incomes, times, terminals_coords
 
 
-def prepare_data():
-    """Read data and make some processing."""
-    incomes, times, _ = read_data()
-    times['Total_Time'] = times['Total_Time'] + 10  # If vehicle arrives, it must spend 10 minutes
-    times['Origin_tid'] = times['Origin_tid'].astype('category')
-    times['Origin_tid_idx'] = times['Origin_tid'].cat.codes
+def _prepare_cash_ts(cash_ts: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return Incomes sheet with integer TID and numeric day columns of one dtype,
+    so cached sheet is the same as the read one and is saved without pickle.
+    """
+    cash = cash_ts.drop(columns="TID").apply(pd.to_numeric)
+    cash = cash.astype(np.result_type(*cash.dtypes)) if len(cash.columns) else cash
+    return pd.concat([cash_ts["TID"].astype(np.int64), cash], axis=1)
+
 
-    incomes = pd.melt(incomes, id_vars=["TID"], var_name="timestamp", value_name="cash")
-    incomes.loc[incomes["timestamp"] == "остаток на 31.08.2022 (входящий)", "timestamp"] = "2022-08-31 00:00:00"
+def _prepare_incomes(cash_ts: pd.DataFrame) -> pd.DataFrame:
+    incomes = pd.melt(cash_ts, id_vars=["TID"], var_name="timestamp", value_name="cash")
+    incomes.loc[incomes["timestamp"] == INITIAL_BALANCE_COLUMN, "timestamp"] = INITIAL_BALANCE_DATE
     incomes["timestamp"] = pd.to_datetime(incomes["timestamp"])
-    return incomes, times
+    return incomes
 
 
-def get_mappings() -> tuple[dict[int, int]]:
-    """Return mappings from TID to number from 0 to lenngth of unnique TIDs and vice versa."""
-    _, times = prepare_data()
-    tid_2_idx = {tid: idx for _, (tid, idx) in times[['Origin_tid', 'Origin_tid_idx']].drop_duplicates().iterrows()}
+def _prepare_times(times: pd.DataFrame, tids: np.ndarray = None) -> pd.DataFrame:
+    times = times.copy()
+    times['Total_Time'] = times['Total_Time'] + 10  # If vehicle arrives, it must spend 10 minutes
+    # terminals can be known only by coordinates, then all their times are estimated
+    times['Origin_tid'] = pd.Categorical(times['Origin_tid'], categories=tids)
+    times['Origin_tid_idx'] = times['Origin_tid'].cat.codes
+    return times
+
+
+def _build_mappings(times: pd.DataFrame) -> tuple[dict[int, int], dict[int, int]]:
+    # category codes are positions of TIDs in sorted categories
+    tid_2_idx = {tid: idx for idx, tid in enumerate(times['Origin_tid'].cat.categories.tolist())}
     idx_2_tid = {idx: tid for tid, idx in tid_2_idx.items()}
     return tid_2_idx, idx_2_tid
 
 
-def create_distance_matrix() -> np.ndarray:
-    """Return distance matriix from times df: Origin TID -> Destination TID times."""
-    _, times = prepare_data()
-    tid_2_idx, _ = get_mappings()
+def haversine(latitudes: np.ndarray, longitudes: np.ndarray, other_latitudes: np.ndarray, other_longitudes: np.ndarray):
+    """Return great circle distances in km between points, arrays are broadcasted as usual."""
+    lat, lon = np.radians(latitudes), np.radians(longitudes)
+    other_lat, other_lon = np.radians(other_latitudes), np.radians(other_longitudes)
+    a = np.sin((other_lat - lat) / 2) ** 2 + np.cos(lat) * np.cos(other_lat) * np.sin((other_lon - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def haversine_matrix(
+        latitudes: np.ndarray,
+        longitudes: np.ndarray,
+        other_latitudes: np.ndarray = None,
+        other_longitudes: np.ndarray = None,
+    ) -> np.ndarray:
+    """Return great circle distances in km from every point to every other point (all points by default)."""
+    if other_latitudes is None:
+        other_latitudes, other_longitudes = latitudes, longitudes
+    return haversine(latitudes[:, None], longitudes[:, None], other_latitudes[None, :], other_longitudes[None, :])
+
+
+def fit_speed_model(times: pd.DataFrame, terminals_coords: pd.DataFrame, sample_size: int = 100_000) -> SpeedModel:
+    """Fit speed and fixed time of SpeedModel by known travel times (Total_Time from times.csv) with least squares."""
+    coords = terminals_coords.set_index("TID")[["latitude", "longitude"]]
+    known = times[times["Origin_tid"].isin(coords.index) & times["Destination_tid"].isin(coords.index)]
+    if len(known) < 2:
+        return SpeedModel()
+    known = known.sample(min(sample_size, len(known)), random_state=0)
+    origins = coords.loc[known["Origin_tid"]].to_numpy()
+    destinations = coords.loc[known["Destination_tid"]].to_numpy()
+    distance_km = haversine(origins[:, 0], origins[:, 1], destinations[:, 0], destinations[:, 1])
+    minutes_per_km, fixed_minutes = np.polyfit(distance_km, known["Total_Time"].to_numpy(dtype=float), 1)
+    if minutes_per_km <= 0:
+        return SpeedModel()
+    return SpeedModel(speed_kmh=60 / minutes_per_km, detour_factor=1, fixed_minutes=max(fixed_minutes, 0))
+
+
+def estimate_times(
+        terminals_coords: pd.DataFrame,
+        tids: np.ndarray = None,
+        speed_model: SpeedModel = SpeedModel(),
+        chunk_size: int = ESTIMATE_CHUNK_SIZE,
+        out: np.ndarray = None,
+    ) -> np.ndarray:
+    """
+    Return matrix of travel times in minutes between terminals (in order of tids) estimated by their coordinates.
+    Rows are computed by chunks, so temporary memory is chunk_size x number of terminals.
+    If out is given, only its cells < 0 are filled.
+    """
+    coords = terminals_coords.set_index("TID")
+    tids = coords.index.to_numpy() if tids is None else tids
+    missing_coords = np.setdiff1d(tids, coords.index.to_numpy())
+    if len(missing_coords):
+        raise ValueError(f"There are no coordinates of terminals {missing_coords[:10].tolist()}")
+    # float32 is twice faster and precise enough for minutes
+    latitudes = coords.loc[tids, "latitude"].to_numpy(dtype=np.float32)
+    longitudes = coords.loc[tids, "longitude"].to_numpy(dtype=np.float32)
+
+    fill_missing = out is not None
+    if out is None:
+        out = np.empty((len(tids), len(tids)), dtype=DISTANCE_DTYPE)
+    for start in range(0, len(tids), chunk_size):
+        rows = slice(start, start + chunk_size)
+        missing = out[rows] < 0 if fill_missing else None
+        if fill_missing and not missing.any():
+            continue
+        minutes = np.rint(speed_model.minutes(
+            haversine_matrix(latitudes[rows], longitudes[rows], latitudes, longitudes)
+        )).astype(out.dtype)
+        if fill_missing:
+            out[rows][missing] = minutes[missing]
+        else:
+            out[rows] = minutes
+    np.fill_diagonal(out, 0)
+    return out
+
+
+def _build_distance_matrix(
+        times: pd.DataFrame,
+        terminals_coords: pd.DataFrame = None,
+        dtype=DISTANCE_DTYPE,
+        speed_model: SpeedModel = None,
+    ) -> np.ndarray:
+    """
+    Return dense matrix filled straight from category codes, times are rounded to minutes for ortools.
+    Pairs which are not in times are estimated by coordinates with speed_model (fitted by known times by default).
+    """
+    tids = times["Origin_tid"].cat.categories.to_numpy()
+    total_time = np.rint(times["Total_Time"].values)
+    # -1 is a mark of pairs without time
+    distance_matrix = np.full((len(tids), len(tids)), -1, dtype=np.int32)
+    distance_matrix[times["Origin_tid_idx"].values, times["Destination_tid_idx"].values] = total_time
+    # time from terminal to itself is zero
+    np.fill_diagonal(distance_matrix, 0)
+
+    if (distance_matrix < 0).any():
+        if terminals_coords is None:
+            raise ValueError("Some travel times are missing and there are no coordinates to estimate them")
+        if speed_model is None and len(times):
+            # model is fitted by times without 10 minutes in terminal
+            speed_model = fit_speed_model(times.assign(Total_Time=times["Total_Time"] - 10), terminals_coords)
+        speed_model = speed_model or SpeedModel()
+        # If vehicle arrives, it must spend 10 minutes
+        speed_model = SpeedModel(speed_model.speed_kmh, speed_model.detour_factor, speed_model.fixed_minutes + 10)
+        estimate_times(terminals_coords, tids, speed_model, out=distance_matrix)
+
+    if distance_matrix.max(initial=0) > np.iinfo(dtype).max:
+        raise ValueError(f"Times up to {distance_matrix.max()} minutes don't fit into {np.dtype(dtype).name}")
+    return distance_matrix.astype(dtype, copy=False)
+
+
+def submatrix(distance_matrix: np.ndarray, rows: list[int], columns: list[int] = None, dtype=np.int64) -> np.ndarray:
+    """
+    Return distance_matrix[rows][:, columns] as a small array of dtype.
+    Only selected cells are read, so memory-mapped matrix is not loaded into memory.
+    """
+    columns = rows if columns is None else columns
+    return distance_matrix[np.ix_(rows, columns)].astype(dtype)
+
+
+def pair_distances(distance_matrix: np.ndarray, origins: np.ndarray, destinations: np.ndarray, dtype=np.int64) -> np.ndarray:
+    """Return times from every origin to destination with the same position as array of dtype."""
+    return distance_matrix[origins, destinations].astype(dtype)
+
+
+def build_data_context(
+        cash_ts: pd.DataFrame,
+        times: pd.DataFrame,
+        terminals_coords: pd.DataFrame,
+        distance_matrix: np.ndarray = None,
+        distance_matrix_path: str = None,
+        speed_model: SpeedModel = None,
+    ) -> DataContext:
+    """
+    Make all processing of raw data (as returned by read_data) and pack it into DataContext.
+    Terminals are all TIDs from times and coordinates, missing times are estimated by coordinates with speed_model.
+    """
+    tids = np.unique(np.concatenate([
+        times["Origin_tid"].to_numpy(), times["Destination_tid"].to_numpy(), terminals_coords["TID"].to_numpy(),
+    ]).astype(np.int64))
+    times = _prepare_times(times, tids)
+    tid_2_idx, idx_2_tid = _build_mappings(times)
     times["Destination_tid_idx"] = times["Destination_tid"].map(tid_2_idx)
-    distance_matrix = pd.concat([
-        times[["Origin_tid_idx", "Destination_tid_idx", "Total_Time"]],
-        pd.DataFrame({
-            "Origin_tid_idx": range(times["Origin_tid"].nunique()),
-            "Destination_tid_idx": range(times["Origin_tid"].nunique()),
-            "Total_Time": 0
+    if distance_matrix is None:
+        distance_matrix = _build_distance_matrix(times, terminals_coords, speed_model=speed_model)
+    return DataContext(
+        cash_ts=cash_ts,
+        incomes=_prepare_incomes(cash_ts),
+        times=times,
+        terminals_coords=terminals_coords,
+        tid_2_idx=tid_2_idx,
+        idx_2_tid=idx_2_tid,
+        distance_matrix=distance_matrix,
+        distance_matrix_path=distance_matrix_path,
+    )
+
+
+def _cache_key(*paths: str) -> str:
+    """Fingerprint of source files: path, modification time and size."""
+    fingerprint = []
+    for path in paths:
+        if path is None:
+            fingerprint.append("None")
+            continue
+        stat = os.stat(path)
+        fingerprint.append(f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}")
+    return hashlib.sha1("|".join(fingerprint).encode()).hexdigest()[:16]
+
+
+def _save_cache(cache_file: str, cash_ts: pd.DataFrame, times: pd.DataFrame, terminals_coords: pd.DataFrame):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        np.savez(
+            f,
+            # TID is kept apart from cash, so it stays integer if some day column is float
+            incomes_tids=cash_ts["TID"].to_numpy(),
+            incomes_columns=np.array(cash_ts.columns.drop("TID").tolist(), dtype=str),
+            incomes_values=cash_ts.drop(columns="TID").to_numpy(),
+            times_origin=times["Origin_tid"].values,
+            times_destination=times["Destination_tid"].values,
+            times_total=times["Total_Time"].values,
+            coords_columns=np.array(terminals_coords.columns.tolist(), dtype=str),
+            coords_values=terminals_coords.values,
+            coords_tids=terminals_coords["TID"].values,
+        )
+    # rename is atomic, so concurrent readers never see half-written file
+    os.replace(tmp_file, cache_file)
+
+
+def save_distance_matrix(path: str, distance_matrix: np.ndarray):
+    """Save distance matrix as npy file, which can be memory-mapped by open_distance_matrix."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        np.save(f, distance_matrix)
+    os.replace(tmp_file, path)
+
+
+def open_distance_matrix(path: str) -> np.ndarray:
+    """
+    Return read-only memory-mapped distance matrix.
+    All processes which open the same file share its pages, so memory doesn't grow with number of workers.
+    """
+    return np.load(path, mmap_mode="r")
+
+
+def _load_cache(cache_file: str) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    with np.load(cache_file) as cache:
+        cash_ts = pd.DataFrame(cache["incomes_values"], columns=cache["incomes_columns"].tolist())
+        cash_ts.insert(0, "TID", cache["incomes_tids"])
+        times = pd.DataFrame({
+            "Origin_tid": cache["times_origin"],
+            "Destination_tid": cache["times_destination"],
+            "Total_Time": cache["times_total"],
         })
-    ])
-    distance_matrix = distance_matrix.pivot_table(index="Origin_tid_idx", columns="Destination_tid_idx").values
-    distance_matrix = distance_matrix.round(0).astype(int)  # for ortools because it works only with int
-    return distance_matrix
-
-
-# from geopy.distance import geodesic
-# def calculate_distances(df: pd.DataFrame) -> np.array:
-#     distances = np.zeros((df.shape[0], df.shape[0]))
-#     for i1, row1 in tqdm(df.iloc[:-1].iterrows()):
-#         for i2, row2 in df.iloc[i1 + 1:].iterrows():
-#             distance = geodesic((row1["latitude"], row1["longitude"]), (row2["latitude"], row2["longitude"])).meters
-#             distances[i1, i2] = distance
-#             distances[i2, i1] = distance
-#     return distances
+        terminals_coords = pd.DataFrame(cache["coords_values"], columns=cache["coords_columns"].tolist())
+        terminals_coords["TID"] = cache["coords_tids"]
+    return cash_ts, times, terminals_coords
+
+
+@timed("load_data_context")
+def load_data_context(
+        incomes_path: str = INCOMES_PATH,
+        times_path: str = TIMES_PATH,
+        cache_dir: str = CACHE_DIR,
+        use_cache: bool = True,
+    ) -> DataContext:
+    """
+    Return DataContext for source files.
+    Context is loaded once per process, and raw data is cached on disk in npz format,
+    so warm runs don't parse Excel at all. Cache is invalidated if any source file changes.
+    Distance matrix is cached in a separate npy file and memory-mapped read-only.
+    """
+    key = _cache_key(incomes_path, times_path)
+    if key in _loaded_contexts:
+        return _loaded_contexts[key]
+
+    cache_file = os.path.join(cache_dir, f"context_v{CACHE_FORMAT_VERSION}_{key}.npz")
+    matrix_file = os.path.join(cache_dir, f"distance_matrix_{key}_{np.dtype(DISTANCE_DTYPE).name}.npy")
+    if use_cache and os.path.exists(cache_file):
+        cash_ts, times, terminals_coords = _load_cache(cache_file)
+    else:
+        cash_ts, times, terminals_coords = read_data(incomes_path, times_path)
+        cash_ts = _prepare_cash_ts(cash_ts)
+        if use_cache:
+            _save_cache(cache_file, cash_ts, times, terminals_coords)
+
+    if not use_cache:
+        ctx = build_data_context(cash_ts, times, terminals_coords)
+    elif os.path.exists(matrix_file):
+        ctx = build_data_context(cash_ts, times, terminals_coords, open_distance_matrix(matrix_file), matrix_file)
+    else:
+        ctx = build_data_context(cash_ts, times, terminals_coords)
+        save_distance_matrix(matrix_file, ctx.distance_matrix)
+        ctx.distance_matrix, ctx.distance_matrix_path = open_distance_matrix(matrix_file), matrix_file
+
+    _loaded_contexts[key] = ctx
+    return ctx
+
+
+def get_cash_matrix(ctx: DataContext = None) -> tuple[np.ndarray, pd.DatetimeIndex, np.ndarray]:
+    """Return sorted TIDs, sorted days and dense (terminal x day) cash matrix, first day is initial balance."""
+    ctx = ctx or load_data_context()
+    cash_ts = ctx.cash_ts.set_index("TID").sort_index()
+    days = pd.to_datetime(
+        cash_ts.columns.where(cash_ts.columns != INITIAL_BALANCE_COLUMN, INITIAL_BALANCE_DATE)
+    )
+    order = np.argsort(days.values, kind="stable")
+    return cash_ts.index.values, days[order], cash_ts.values[:, order]
+
+
+def prepare_data(ctx: DataContext = None):
+    """Read data and make some processing."""
+    ctx = ctx or load_data_context()
+    return ctx.incomes.copy(), ctx.times.copy()
+
+
+def get_mappings(ctx: DataContext = None) -> tuple[dict[int, int]]:
+    """Return mappings from TID to number from 0 to lenngth of unnique TIDs and vice versa."""
+    ctx = ctx or load_data_context()
+    return ctx.tid_2_idx, ctx.idx_2_tid
+
+
+def create_distance_matrix(ctx: DataContext = None) -> np.ndarray:
+    """Return distance matriix from times df: Origin TID -> Destination TID times."""
+    ctx = ctx or load_data_context()
+    return np.array(ctx.distance_matrix)
 
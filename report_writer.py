@@ -0,0 +1,149 @@
+import io
+import os
+import tempfile
+from typing import Iterator
+
+import pandas as pd
+
+from metrics import timed
+
+REPORT_FORMATS = ("xlsx", "csv", "parquet")
+MEDIA_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+# rows are converted and written by chunks, so only one chunk of a sheet is copied at a time
+CHUNK_SIZE = 10_000
+# xlsx is built in a temporary file, which is kept in memory until it gets bigger than this
+MAX_XLSX_IN_MEMORY = 16 * 2**20
+FILE_BLOCK_SIZE = 2**20
+
+
+def iter_chunks(df: pd.DataFrame, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size]
+
+
+def iter_csv(df: pd.DataFrame, index: bool = False, chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    """Yield CSV of df by chunks of rows, the first one is header."""
+    yield df.iloc[:0].to_csv(index=index)
+    for chunk in iter_chunks(df, chunk_size):
+        yield chunk.to_csv(index=index, header=False)
+
+
+class _DrainableBuffer(io.RawIOBase):
+    """Write-only file which gives away written bytes, so they are not kept after they are sent."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("pyarrow is needed to write reports in parquet format: pip install pyarrow") from e
+    return pyarrow, pyarrow.parquet
+
+
+def iter_parquet(df: pd.DataFrame, index: bool = False, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield parquet file of df, every chunk of rows is a separate row group which is yielded when it is written."""
+    pa, pq = _import_pyarrow()
+    # types of object columns can't be found from empty frame
+    schema = pa.Schema.from_pandas(df.iloc[:chunk_size], preserve_index=index)
+    sink = _DrainableBuffer()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for chunk in iter_chunks(df, chunk_size):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=index))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _iter_rows(df: pd.DataFrame, index: bool, chunk_size: int) -> Iterator[list]:
+    yield ([df.index.name] if index else []) + df.columns.tolist()
+    for chunk in iter_chunks(df, chunk_size):
+        # empty cells instead of NaN as in pd.ExcelWriter
+        if chunk.isna().values.any():
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+        yield from chunk.itertuples(index=index, name=None)
+
+
+def write_xlsx(file, sheets: dict[str, tuple[pd.DataFrame, bool]], chunk_size: int = CHUNK_SIZE):
+    """Write sheets: name -> (df, write index or not) into xlsx file or path with write-only (constant memory) workbook."""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    for sheet_name, (df, index) in sheets.items():
+        worksheet = workbook.create_sheet(sheet_name)
+        for row in _iter_rows(df, index, chunk_size):
+            worksheet.append(row)
+    workbook.save(file)
+
+
+def iter_xlsx(sheets: dict[str, tuple[pd.DataFrame, bool]], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield xlsx file with sheets by blocks, zip archive can't be streamed, so it is built in a temporary file first."""
+    with tempfile.SpooledTemporaryFile(max_size=MAX_XLSX_IN_MEMORY) as file:
+        write_xlsx(file, sheets, chunk_size)
+        file.seek(0)
+        while block := file.read(FILE_BLOCK_SIZE):
+            yield block
+
+
+def iter_report(
+        sheets: dict[str, tuple[pd.DataFrame, bool]],
+        report_format: str = "csv",
+        chunk_size: int = CHUNK_SIZE,
+    ) -> Iterator:
+    """Yield report in format: all sheets for xlsx and only the first sheet for csv and parquet."""
+    if report_format == "xlsx":
+        return iter_xlsx(sheets, chunk_size)
+    if report_format not in REPORT_FORMATS:
+        raise ValueError(f"Unknown report format {report_format}, it must be one of {REPORT_FORMATS}")
+    df, index = next(iter(sheets.values()))
+    return (iter_csv if report_format == "csv" else iter_parquet)(df, index, chunk_size)
+
+
+@timed("write_report")
+def write_report(
+        path: str,
+        sheets: dict[str, tuple[pd.DataFrame, bool]],
+        report_format: str = "xlsx",
+        chunk_size: int = CHUNK_SIZE,
+    ) -> list[str]:
+    """
+    Write sheets: name -> (df, write index or not) and return written files.
+    xlsx is one file with all sheets, csv and parquet are directory with one file per sheet.
+    """
+    if report_format == "xlsx":
+        write_xlsx(path, sheets, chunk_size)
+        return [path]
+    if report_format not in REPORT_FORMATS:
+        raise ValueError(f"Unknown report format {report_format}, it must be one of {REPORT_FORMATS}")
+
+    os.makedirs(path, exist_ok=True)
+    paths = []
+    for sheet_name, (df, index) in sheets.items():
+        paths.append(os.path.join(path, f"{sheet_name}.{report_format}"))
+        with (open(paths[-1], "w", encoding="utf-8") if report_format == "csv" else open(paths[-1], "wb")) as f:
+            for data in iter_report({sheet_name: (df, index)}, report_format, chunk_size):
+                f.write(data)
+    return paths
@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """In-memory LRU cache of JSON-serializable values with optional on-disk store (one file per key)."""
+
+    def __init__(self, max_size: int = 32, cache_dir: str = None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self._data = OrderedDict()
+        self._lock = Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{hashlib.sha1(key.encode()).hexdigest()}.json")
+
+    def get(self, key: str):
+        """Return value or None if there is no such key."""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key]
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        with open(self._path(key), encoding="utf-8") as f:
+            value = json.load(f)
+        self._put_in_memory(key, value)
+        return value
+
+    def put(self, key: str, value):
+        self._put_in_memory(key, value)
+        if self.cache_dir is not None:
+            # rename is atomic, so other processes never read half-written file
+            tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+
+    def _put_in_memory(self, key: str, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
@@ -1,47 +1,116 @@
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
-from prepare_data import get_mappings, create_distance_matrix
+from datetime import datetime
+from itertools import chain
+from find_terminals_to_cash_out import STOP_TIME
+from get_routes import DEFAULT_TIME_WINDOWS, TimeWindows
+from metrics import timed
+from prepare_data import DataContext, load_data_context, pair_distances
 
 
-def get_schedules_of_vehicles(routes_with_num_vehiles: dict) -> dict:
-    """Return everyday schedule of armoured vehicles based on their routes."""
-    tid_2_idx, _ = get_mappings()
-    # we need to add 10 minutes to do incassation
-    distance_matrix = create_distance_matrix() - 10
-    # we can't go back in time ;)
-    distance_matrix[distance_matrix < 0] = 0
-
-    schedules = {}
+def _schedule_columns(
+        routes_with_num_vehiles: dict,
+        ctx: DataContext,
+        time_windows: TimeWindows = DEFAULT_TIME_WINDOWS,
+    ) -> dict[str, np.ndarray]:
+    """
+    Return arrays of days, vehicles, terminals, arrival and departure times for all stops of all routes.
+    Every vehicle starts at the beginning of its shift (08:00 by default) and spends service time
+    (10 minutes by default) in every terminal, it waits for opening if it arrives to a terminal earlier.
+    """
+    day_strs, vehicle_ids, route_lengths, terminal_ids = [], [], [], []
     for day_str, inner_dict in routes_with_num_vehiles.items():
-        schedules[day_str] = {}
         for vehicle_id, route in enumerate(inner_dict["route"]):
-            cur_time = datetime.strptime(day_str, "%Y-%m-%d %H:%M:%S") + timedelta(hours=8)
-            terminal_ids = [tid_2_idx[tid] for tid in route]
-            schedules[day_str][vehicle_id] = {}
+            day_strs.append(day_str)
+            vehicle_ids.append(vehicle_id)
+            route_lengths.append(len(route))
+            terminal_ids.append(route)
+    route_lengths = np.array(route_lengths, dtype=np.int64)
+    terminal_ids = np.fromiter(chain.from_iterable(terminal_ids), dtype=np.int64, count=route_lengths.sum())
+
+    # TID -> index of distance matrix for all stops at once
+    tids = np.fromiter(ctx.tid_2_idx.keys(), dtype=np.int64, count=len(ctx.tid_2_idx))
+    indices = np.fromiter(ctx.tid_2_idx.values(), dtype=np.int64, count=len(ctx.tid_2_idx))
+    order = np.argsort(tids)
+    terminal_indices = indices[order][np.searchsorted(tids[order], terminal_ids)]
 
-            if len(terminal_ids) == 1:
-                # If a vehicle has only 1 terminal to attend
-                schedules[day_str][vehicle_id][route[0]] = (
-                    cur_time,
-                    cur_time + timedelta(minutes=10)
-                )
-            else:
-                for i in range(1, len(terminal_ids)):
-                    schedules[day_str][vehicle_id][route[i - 1]] = (
-                        cur_time,
-                        cur_time + timedelta(minutes=10)
-                    )
+    # travel from previous terminal + service in previous terminal, first terminal of a route is at start of shift
+    # distance matrix includes 10 minutes of incassation, and we can't go back in time ;)
+    service_times = time_windows.service_time(terminal_ids)
+    legs = np.zeros(len(terminal_ids), dtype=np.int64)
+    legs[1:] = (
+        np.maximum(pair_distances(ctx.distance_matrix, terminal_indices[:-1], terminal_indices[1:]) - STOP_TIME, 0)
+        + service_times[:-1]
+    )
+    route_starts = (np.cumsum(route_lengths) - route_lengths)[route_lengths > 0]
+    legs[route_starts] = 0
 
-                    time_to_next_terminal = int(distance_matrix[terminal_ids[i-1], terminal_ids[i]])
-                    cur_time += timedelta(minutes=time_to_next_terminal + 10)
-                
-                if i == len(terminal_ids) - 1:
-                    # Don't forget about last terminal
-                    schedules[day_str][vehicle_id][route[i]] = (
-                        cur_time,
-                        cur_time + timedelta(minutes=10)
-                    )
+    # arrival without waiting is cumulative sum of legs inside of a route
+    route_ids = np.repeat(np.arange(len(route_starts)), route_lengths[route_lengths > 0])
+    cumsum = np.cumsum(legs)
+    minutes = cumsum - cumsum[route_starts][route_ids]
+    # vehicle can't start before its shift and terminal before its opening,
+    # waiting shifts all next stops: arrival = minutes + running maximum of (earliest - minutes) inside of a route
+    earliest, _ = time_windows.windows(terminal_ids)
+    shift_starts = np.array([time_windows.vehicle_shift(vehicle_id)[0] for vehicle_id in vehicle_ids], dtype=np.int64)
+    earliest[route_starts] = np.maximum(earliest[route_starts], shift_starts[route_lengths > 0])
+    delays = earliest - minutes
+    # offset of every route makes running maximum restart in every route
+    offset = 2 * (np.abs(delays).max(initial=0) + 1)
+    delays = np.maximum.accumulate(delays + route_ids * offset) - route_ids * offset
+    minutes += delays
 
+    day_starts = pd.to_datetime(day_strs, format="%Y-%m-%d %H:%M:%S").values.astype("datetime64[m]")
+    arrivals = np.repeat(day_starts, route_lengths) + minutes.astype("timedelta64[m]")
+    return {
+        "day_str": np.repeat(np.array(day_strs, dtype=object), route_lengths),
+        "vehicle_id": np.repeat(np.array(vehicle_ids, dtype=np.int64), route_lengths),
+        "terminal_id": terminal_ids,
+        "arrival": arrivals,
+        "departure": arrivals + service_times.astype("timedelta64[m]"),
+    }
+
+
+@timed("create_schedules_report")
+def create_schedules_report(
+        routes_with_num_vehiles: dict,
+        ctx: DataContext = None,
+        time_windows: TimeWindows = DEFAULT_TIME_WINDOWS,
+    ) -> pd.DataFrame:
+    """Return report of every day schedule of armoured vehicles based on their routes."""
+    ctx = ctx or load_data_context()
+    columns = _schedule_columns(routes_with_num_vehiles, ctx, time_windows)
+    return pd.DataFrame({
+        "день": [day_str.split()[0] for day_str in columns["day_str"]] if len(columns["day_str"]) else [],
+        "порядковый номер броневика": columns["vehicle_id"],
+        "устройство": columns["terminal_id"],
+        "дата-время прибытия": columns["arrival"].astype("datetime64[ns]"),
+        "дата-время отъезда": columns["departure"].astype("datetime64[ns]"),
+    })
+
+
+@timed("get_schedules_of_vehicles")
+def get_schedules_of_vehicles(
+        routes_with_num_vehiles: dict,
+        ctx: DataContext = None,
+        time_windows: TimeWindows = DEFAULT_TIME_WINDOWS,
+    ) -> dict:
+    """Return everyday schedule of armoured vehicles based on their routes."""
+    ctx = ctx or load_data_context()
+    columns = _schedule_columns(routes_with_num_vehiles, ctx, time_windows)
+
+    schedules = {
+        day_str: {vehicle_id: {} for vehicle_id in range(len(inner_dict["route"]))}
+        for day_str, inner_dict in routes_with_num_vehiles.items()
+    }
+    for day_str, vehicle_id, terminal_id, arrival, departure in zip(
+            columns["day_str"],
+            columns["vehicle_id"].tolist(),
+            columns["terminal_id"].tolist(),
+            columns["arrival"].astype(datetime).tolist(),
+            columns["departure"].astype(datetime).tolist(),
+        ):
+        schedules[day_str][vehicle_id][terminal_id] = (arrival, departure)
     return schedules
 
 
@@ -59,57 +128,3 @@ def create_report_for_schedules(schedules: dict) -> pd.DataFrame:
                     "дата-время отъезда": departure_time
                 })
     return pd.DataFrame(df_data)
-
-
-def postprocess_schedules(schedules_report: pd.DataFrame) -> pd.DataFrame:
-    """
-    If somehow some vehicle gets terminals after 20:00,
-    it is needed to give these terminals to another vehicles.
-    So, we find such terminals, find free vehicles and assigm these terminals to these free vehicles.
-    """
-    tid_2_idx, _ = get_mappings()
-    distance_matrix = create_distance_matrix()
-    schedules_report_copy = schedules_report.copy()
-    violated_routes = schedules_report[pd.to_datetime(schedules_report["дата-время отъезда"]).dt.hour >= 20]
-    new_rows = []
-    # going by violations and get cars with some free space in it
-    for idx, row in violated_routes.iterrows():
-        free_vehicle = (
-            schedules_report_copy[
-                (schedules_report_copy["день"] == row["день"])
-                & (schedules_report_copy["порядковый номер броневика"] != row["порядковый номер броневика"])
-            ]
-            .groupby("порядковый номер броневика")
-            ["дата-время отъезда"]
-            .agg("max")
-            .idxmin()
-        )
-
-        # get routes of "free" vehicles
-        terminals_of_free_vehicle = schedules_report_copy[
-            (schedules_report_copy["день"] == row["день"])
-            & (schedules_report_copy["порядковый номер броневика"] == free_vehicle)
-        ].sort_values("дата-время отъезда")
-
-        last_terminal_of_free_vehicle = terminals_of_free_vehicle["устройство"].values[-1]
-        last_arrival_of_free_vehicle = terminals_of_free_vehicle["дата-время отъезда"].tolist()[-1]
-        time_to_next_terminal = int(
-            distance_matrix[tid_2_idx[last_terminal_of_free_vehicle], tid_2_idx[row["устройство"]]]
-        ) - 10  # We add 10 minutes to all times Origin TID -> Destination TID, so we need to subtract 10
-
-        assert (
-            (last_arrival_of_free_vehicle + timedelta(minutes=time_to_next_terminal + 10)).hour < 20,
-            f"Cannot move terminal {row['устройство']} to another vehicle {free_vehicle} on {row['день']}"
-        )
-
-        # change vehicle for some points
-        new_row = {
-            "день": row["день"],
-            "порядковый номер броневика": free_vehicle,
-            "устройство": row["устройство"],
-            "дата-время прибытия": last_arrival_of_free_vehicle + timedelta(minutes=time_to_next_terminal),
-            "дата-время отъезда": last_arrival_of_free_vehicle + timedelta(minutes=time_to_next_terminal + 10),
-        }
-        new_rows.append(pd.DataFrame(new_row, index=[0]))
-        schedules_report_copy = schedules_report_copy.drop(index=[idx])
-    return pd.concat([schedules_report_copy, pd.concat(new_rows)]).reset_index(drop=True)
@@ -0,0 +1,141 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from calculate_costs import incassation_price_array
+from find_terminals_to_cash_out import MAX_AMT, MAX_DOWNTIME, PCT
+from metrics import timed
+from prepare_data import load_data_context
+
+# policies are simulated by chunks: state of a chunk fits in CPU cache and memory doesn't grow with the grid
+POLICY_CHUNK_SIZE = 128
+
+
+def policy_grid(cash_weights: np.ndarray, top_ks: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return cash weights and top_k of all pairs of the grid."""
+    cash_weights, top_ks = np.meshgrid(np.asarray(cash_weights, dtype=float), np.asarray(top_ks, dtype=np.int64), indexing="ij")
+    return cash_weights.ravel(), top_ks.ravel()
+
+
+def _top_k_mask(scores: np.ndarray, ks: np.ndarray) -> np.ndarray:
+    """
+    Return mask of ks[p] largest scores of every row p, ties are taken by position as in top_k_positions.
+    Only max(ks) largest scores of rows are sorted, instead of whole rows.
+    """
+    num_columns = scores.shape[1]
+    max_k = min(int(ks.max(initial=0)), num_columns)
+    if max_k == 0:
+        return np.zeros(scores.shape, dtype=bool)
+    # max_k largest scores of every row in ascending order
+    top = np.partition(scores, num_columns - max_k, axis=1)[:, num_columns - max_k:]
+    top.sort(axis=1)
+    # k-th largest score of the row, nothing is taken if k is 0
+    threshold = np.where(ks > 0, top[np.arange(len(ks)), max_k - np.clip(ks, 1, max_k)], np.inf)[:, None]
+    above = scores > threshold
+    on_threshold = scores == threshold
+    remaining = np.minimum(ks, num_columns) - np.count_nonzero(above, axis=1)
+    # ties on the threshold are taken by position only in rows where there are more of them than needed
+    rows = np.flatnonzero(np.count_nonzero(on_threshold, axis=1) > remaining)
+    on_threshold[rows] &= np.cumsum(on_threshold[rows], axis=1) <= remaining[rows, None]
+    above |= on_threshold
+    return above
+
+
+def _simulate_chunk(cash: np.ndarray, cash_weights: np.ndarray, top_ks: np.ndarray) -> pd.DataFrame:
+    cash_weights = cash_weights[:, None]
+    num_policies, (num_terminals, num_days) = len(top_ks), cash.shape
+
+    balances = np.repeat(cash[None, :, 0], num_policies, axis=0).astype(float)
+    # float downtime is not converted every day to compute scores
+    downtime = np.zeros((num_policies, num_terminals))
+    violations = np.zeros(num_policies, dtype=np.int64)
+    collections = np.zeros(num_policies, dtype=np.int64)
+    max_daily_collections = np.zeros(num_policies, dtype=np.int64)
+    collection_cost = np.zeros(num_policies)
+    funding_cost = np.zeros(num_policies)
+    # state is updated in place, arrays are too big to be allocated every day
+    scores = np.empty_like(balances)
+    downtime_scores = np.empty_like(balances)
+
+    for day in range(1, num_days):
+        required = balances >= MAX_AMT
+        num_required = np.count_nonzero(required, axis=1)
+        # same operations as in PoiStats, so equal scores are equal here too
+        np.multiply(cash_weights, balances, out=scores)
+        scores /= MAX_AMT
+        np.multiply(1 - cash_weights, downtime, out=downtime_scores)
+        downtime_scores /= MAX_DOWNTIME
+        scores += downtime_scores
+        # required terminals are taken anyway, so they are sorted after all optional ones
+        scores[required] = -np.inf
+        daily = _top_k_mask(scores, np.maximum(0, top_ks - num_required))
+        daily |= required
+
+        # costs of the day depend on cash at the end of previous day, only a small part of terminals is collected
+        policies, terminals = np.nonzero(daily)
+        collected = balances[policies, terminals]
+        collection_cost += np.bincount(policies, incassation_price_array(collected), num_policies)
+        funding_cost += PCT * (balances.sum(axis=1) - np.bincount(policies, collected, num_policies))
+
+        downtime += 1
+        downtime[policies, terminals] = 0
+        balances += cash[:, day]
+        balances[policies, terminals] = cash[terminals, day]
+        violations += np.count_nonzero(downtime >= MAX_DOWNTIME, axis=1) + np.maximum(0, num_required - top_ks)
+        daily_collections = np.bincount(policies, minlength=num_policies)
+        collections += daily_collections
+        np.maximum(max_daily_collections, daily_collections, out=max_daily_collections)
+
+    return pd.DataFrame({
+        "cash_weight": cash_weights[:, 0],
+        "top_k": top_ks,
+        "violations": violations,
+        "collections": collections,
+        "max_daily_collections": max_daily_collections,
+        "collection_cost": collection_cost,
+        "funding_cost": funding_cost,
+        "total_cost": collection_cost + funding_cost,
+    })
+
+
+@timed("simulate_policies")
+def simulate_policies(
+        cash: np.ndarray,
+        cash_weights: np.ndarray,
+        top_ks: np.ndarray,
+        chunk_size: int = POLICY_CHUNK_SIZE,
+    ) -> pd.DataFrame:
+    """
+    Replay (terminal x day) cash matrix for many PoiStats policies at once, the first day is initial balance.
+    Policy p collects terminals with at least MAX_AMT and the best scored others up to top_ks[p] terminals,
+    score is cash_weights[p] * balance / MAX_AMT + (1 - cash_weights[p]) * downtime / MAX_DOWNTIME.
+    State of chunk_size policies is (policy x terminal) arrays, so a day is a few array operations for all of them.
+    Return violations, collections and costs (as in calc_daily_costs) of every policy.
+    """
+    cash_weights = np.asarray(cash_weights, dtype=float)
+    top_ks = np.asarray(top_ks, dtype=np.int64)
+    return pd.concat([
+        _simulate_chunk(cash, cash_weights[start:start + chunk_size], top_ks[start:start + chunk_size])
+        for start in range(0, len(top_ks), chunk_size)
+    ], ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay incomes history for a grid of terminals selection policies.")
+    parser.add_argument("--weights", type=float, nargs=3, default=(0.01, 0.99, 50), metavar=("MIN", "MAX", "NUM"),
+                        help="cash weights: NUM values from MIN to MAX")
+    parser.add_argument("--top-k", type=int, nargs=3, default=(90, 150, 5), metavar=("MIN", "MAX", "STEP"),
+                        help="terminals per day: from MIN to MAX with STEP")
+    parser.add_argument("--output", default="policies.csv", help="CSV file with results of every policy")
+    args = parser.parse_args()
+
+    ctx = load_data_context()
+    cash_weights, top_ks = policy_grid(
+        np.linspace(args.weights[0], args.weights[1], int(args.weights[2])),
+        np.arange(args.top_k[0], args.top_k[1] + 1, args.top_k[2]),
+    )
+    # terminals keep order of incomes sheet, as in find_terminals_to_cash_out
+    results = simulate_policies(ctx.cash_ts.drop(columns="TID").values, cash_weights, top_ks)
+    results.to_csv(args.output, index=False)
+    print(results.sort_values(["violations", "total_cost"]).head(10).to_string(index=False))
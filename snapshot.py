@@ -0,0 +1,173 @@
+import argparse
+import os
+import shutil
+import warnings
+from dataclasses import dataclass
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+from find_terminals_to_cash_out import BEST_CASH_WEIGHT, BEST_NUM_OF_TERMINALS_TO_CASH_OUT, PoiStats
+from metrics import timed
+from prepare_data import (
+    INCOMES_PATH, INITIAL_BALANCE_COLUMN, INITIAL_BALANCE_DATE, TIMES_PATH, DataContext, _cache_key,
+    load_data_context, open_distance_matrix, save_distance_matrix,
+)
+
+SNAPSHOT_DIR = "data/snapshot"
+STATE_FILE = "state.npz"
+MATRIX_FILE = "distance_matrix.npy"
+POI_STATE_PREFIX = "poi_"
+
+
+@dataclass
+class Snapshot:
+    """Prepared state of the service: cash arrays, terminal mappings, distance matrix and PoiStats state."""
+    tids: np.ndarray  # terminals in order of incomes sheet
+    days: np.ndarray  # dates of cash columns, the first one is initial balance
+    cash: np.ndarray  # (terminal x day) cash
+    idx_2_tid: np.ndarray  # TID of every row of distance matrix
+    distance_matrix: np.ndarray
+    poi_state: dict  # PoiStats.to_state after the first planning day
+    distance_matrix_path: str = None
+    source_key: str = None  # fingerprint of source files the snapshot is made from
+
+    @cached_property
+    def tid_2_idx(self) -> dict[int, int]:
+        return {tid: idx for idx, tid in enumerate(self.idx_2_tid.tolist())}
+
+    def data_context(self) -> DataContext:
+        """
+        Return DataContext with mappings and distance matrix only, which is enough for routes and schedules.
+        Source frames are not kept in the snapshot, so they are None.
+        """
+        return DataContext(
+            cash_ts=None,
+            incomes=None,
+            times=None,
+            terminals_coords=None,
+            tid_2_idx=self.tid_2_idx,
+            idx_2_tid=dict(enumerate(self.idx_2_tid.tolist())),
+            distance_matrix=self.distance_matrix,
+            distance_matrix_path=self.distance_matrix_path,
+        )
+
+    def stat_obj(self) -> PoiStats:
+        return PoiStats.from_state(self.poi_state)
+
+
+@timed("make_snapshot")
+def make_snapshot(
+        ctx: DataContext = None,
+        cash_weight: float = BEST_CASH_WEIGHT,
+        num_terminals: int = BEST_NUM_OF_TERMINALS_TO_CASH_OUT,
+        incomes_path: str = INCOMES_PATH,
+        times_path: str = TIMES_PATH,
+    ) -> Snapshot:
+    """
+    Prepare state of the service: PoiStats starts from initial balance and plans the first day.
+    ctx must be loaded from incomes_path and times_path, their fingerprint is saved to find stale snapshots.
+    """
+    ctx = ctx or load_data_context(incomes_path, times_path)
+    cash_ts = ctx.cash_ts.set_index("TID")
+    days = pd.to_datetime(cash_ts.columns.where(cash_ts.columns != INITIAL_BALANCE_COLUMN, INITIAL_BALANCE_DATE))
+    order = np.argsort(days.values, kind="stable")
+    tids, cash = cash_ts.index.values, cash_ts.values[:, order]
+
+    stat_obj = PoiStats(
+        pd.Series(cash[:, 0], index=tids),
+        num_terminals,
+        start_date=INITIAL_BALANCE_DATE,
+        weights=(cash_weight, 1 - cash_weight),
+    )
+    stat_obj.update_day(cash[:, 1])
+    return Snapshot(
+        tids=tids,
+        days=days[order].strftime("%Y-%m-%d").values.astype(str),
+        cash=cash,
+        idx_2_tid=np.array([ctx.idx_2_tid[idx] for idx in range(len(ctx.idx_2_tid))], dtype=np.int64),
+        distance_matrix=ctx.distance_matrix,
+        poi_state=stat_obj.to_state(),
+        distance_matrix_path=ctx.distance_matrix_path,
+        source_key=_cache_key(incomes_path, times_path),
+    )
+
+
+def save_snapshot(snapshot: Snapshot, path: str = SNAPSHOT_DIR):
+    """Save snapshot into directory: arrays in npz file and distance matrix in npy file to be memory-mapped."""
+    os.makedirs(path, exist_ok=True)
+    matrix_file = os.path.join(path, MATRIX_FILE)
+    if snapshot.distance_matrix_path is not None:
+        shutil.copyfile(snapshot.distance_matrix_path, f"{matrix_file}.tmp")
+        os.replace(f"{matrix_file}.tmp", matrix_file)
+    else:
+        save_distance_matrix(matrix_file, snapshot.distance_matrix)
+
+    state_file = os.path.join(path, STATE_FILE)
+    with open(f"{state_file}.tmp", "wb") as f:
+        np.savez(
+            f,
+            tids=snapshot.tids,
+            days=snapshot.days,
+            cash=snapshot.cash,
+            idx_2_tid=snapshot.idx_2_tid,
+            source_key=np.array(snapshot.source_key or "", dtype=str),
+            **{f"{POI_STATE_PREFIX}{name}": value for name, value in snapshot.poi_state.items()},
+        )
+    os.replace(f"{state_file}.tmp", state_file)
+
+
+@timed("load_snapshot")
+def load_snapshot(path: str = SNAPSHOT_DIR) -> Snapshot:
+    """Load snapshot saved by save_snapshot, distance matrix is memory-mapped read-only."""
+    matrix_file = os.path.join(path, MATRIX_FILE)
+    with np.load(os.path.join(path, STATE_FILE)) as state:
+        return Snapshot(
+            tids=state["tids"],
+            days=state["days"],
+            cash=state["cash"],
+            idx_2_tid=state["idx_2_tid"],
+            distance_matrix=open_distance_matrix(matrix_file),
+            poi_state={
+                name[len(POI_STATE_PREFIX):]: state[name] for name in state.files if name.startswith(POI_STATE_PREFIX)
+            },
+            distance_matrix_path=matrix_file,
+            source_key=str(state["source_key"]) if "source_key" in state.files else None,
+        )
+
+
+def load_or_make_snapshot(
+        path: str = SNAPSHOT_DIR,
+        incomes_path: str = INCOMES_PATH,
+        times_path: str = TIMES_PATH,
+    ) -> Snapshot:
+    """
+    Load snapshot if it is made from current source files, otherwise make it from them and save it,
+    so the next start is fast again. Stale snapshot (source files are changed after it is made) is replaced
+    with a warning. If source files are not available, snapshot is used as is.
+    """
+    if os.path.exists(os.path.join(path, STATE_FILE)):
+        snapshot = load_snapshot(path)
+        try:
+            source_key = _cache_key(incomes_path, times_path)
+        except FileNotFoundError:
+            return snapshot
+        if snapshot.source_key == source_key:
+            return snapshot
+        warnings.warn(f"Snapshot {path} is made from other source files, it is rebuilt")
+
+    snapshot = make_snapshot(load_data_context(incomes_path, times_path), incomes_path=incomes_path, times_path=times_path)
+    try:
+        save_snapshot(snapshot, path)
+    except OSError as e:
+        warnings.warn(f"Snapshot can't be saved into {path}: {e}")
+        return snapshot
+    # saved matrix is opened as in load_snapshot, so workers memory-map the same file
+    return load_snapshot(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prepare state of the API service for fast startup.")
+    parser.add_argument("--output", default=SNAPSHOT_DIR, help="directory of the snapshot")
+    args = parser.parse_args()
+    save_snapshot(make_snapshot(), args.output)
@@ -0,0 +1,220 @@
+import io
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from threading import Lock
+
+import numpy as np
+
+# seconds to wait for lock of sqlite database, which is written by several processes
+SQLITE_TIMEOUT = 30
+
+
+def dump_state(state: dict) -> bytes:
+    """Serialize state of PoiStats.to_state into npz bytes."""
+    buffer = io.BytesIO()
+    np.savez(buffer, **state)
+    return buffer.getvalue()
+
+
+def load_state(data: bytes) -> dict:
+    with np.load(io.BytesIO(data)) as state:
+        return {name: state[name] for name in state.files}
+
+
+class StateStore(ABC):
+    """
+    Versioned history of PoiStats states: version 1 is the initial state, every advanced day is the next version.
+    A new version is written only if the latest one is still the version it was made from (compare-and-swap),
+    so several processes can advance days concurrently without losing or repeating a day.
+    """
+
+    @abstractmethod
+    def latest(self) -> tuple[int, dict] | None:
+        """Return (version, state) of the latest state or None if the store is empty."""
+
+    @abstractmethod
+    def latest_version(self) -> int:
+        """Return the latest version, 0 if the store is empty."""
+
+    @abstractmethod
+    def get(self, version: int) -> dict | None:
+        """Return state of version or None if there is no such version."""
+
+    @abstractmethod
+    def compare_and_swap(self, version: int, state: dict, day: str) -> bool:
+        """Save state as version + 1 if the latest version is version, return if it is saved."""
+
+    @abstractmethod
+    def history(self) -> list[dict]:
+        """Return version, day and creation time of every saved state."""
+
+
+class MemoryStateStore(StateStore):
+    """Store of one process, states are lost on restart."""
+
+    def __init__(self):
+        # version - 1 -> (day, created_at, serialized state)
+        self._states = []
+        self._lock = Lock()
+
+    def latest(self) -> tuple[int, dict] | None:
+        with self._lock:
+            if not self._states:
+                return None
+            return len(self._states), load_state(self._states[-1][2])
+
+    def latest_version(self) -> int:
+        return len(self._states)
+
+    def get(self, version: int) -> dict | None:
+        with self._lock:
+            if not 1 <= version <= len(self._states):
+                return None
+            return load_state(self._states[version - 1][2])
+
+    def compare_and_swap(self, version: int, state: dict, day: str) -> bool:
+        data = dump_state(state)
+        with self._lock:
+            if len(self._states) != version:
+                return False
+            self._states.append((day, time.time(), data))
+            return True
+
+    def history(self) -> list[dict]:
+        with self._lock:
+            return [
+                {"version": version, "day": day, "created_at": created_at}
+                for version, (day, created_at, _) in enumerate(self._states, start=1)
+            ]
+
+
+class SQLiteStateStore(StateStore):
+    """Store in sqlite database, which can be shared by processes of one host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as connection:
+            # readers are not blocked by a writer
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS poi_states "
+                "(version INTEGER PRIMARY KEY, day TEXT NOT NULL, created_at REAL NOT NULL, state BLOB NOT NULL)"
+            )
+        connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # connection per call, so the store can be used from any thread
+        return sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT)
+
+    def _query(self, sql: str, params: tuple = ()) -> list[tuple]:
+        connection = self._connect()
+        try:
+            return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+    def latest(self) -> tuple[int, dict] | None:
+        rows = self._query("SELECT version, state FROM poi_states ORDER BY version DESC LIMIT 1")
+        return (rows[0][0], load_state(rows[0][1])) if rows else None
+
+    def latest_version(self) -> int:
+        return self._query("SELECT COALESCE(MAX(version), 0) FROM poi_states")[0][0]
+
+    def get(self, version: int) -> dict | None:
+        rows = self._query("SELECT state FROM poi_states WHERE version = ?", (version,))
+        return load_state(rows[0][0]) if rows else None
+
+    def compare_and_swap(self, version: int, state: dict, day: str) -> bool:
+        connection = self._connect()
+        try:
+            # one statement is atomic: the check and the insert are done under the write lock
+            with connection:
+                cursor = connection.execute(
+                    "INSERT INTO poi_states (version, day, created_at, state) SELECT ?, ?, ?, ? "
+                    "WHERE (SELECT COALESCE(MAX(version), 0) FROM poi_states) = ?",
+                    (version + 1, day, time.time(), dump_state(state), version),
+                )
+            return cursor.rowcount == 1
+        except sqlite3.IntegrityError:
+            return False
+        finally:
+            connection.close()
+
+    def history(self) -> list[dict]:
+        rows = self._query("SELECT version, day, created_at FROM poi_states ORDER BY version")
+        return [{"version": version, "day": day, "created_at": created_at} for version, day, created_at in rows]
+
+
+class FileStateStore(StateStore):
+    """Store in directory with one npz file per version, e.g. on a shared volume."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, version: int) -> str:
+        return os.path.join(self.directory, f"{version:08d}.npz")
+
+    def _versions(self) -> list[int]:
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".npz"))
+
+    def latest(self) -> tuple[int, dict] | None:
+        versions = self._versions()
+        if not versions:
+            return None
+        return versions[-1], self.get(versions[-1])
+
+    def latest_version(self) -> int:
+        return max(self._versions(), default=0)
+
+    def get(self, version: int) -> dict | None:
+        if not os.path.exists(self._path(version)):
+            return None
+        with open(self._path(version), "rb") as f:
+            state = load_state(f.read())
+        for name in ("store_day", "store_created_at"):
+            state.pop(name)
+        return state
+
+    def compare_and_swap(self, version: int, state: dict, day: str) -> bool:
+        if self.latest_version() != version:
+            return False
+        tmp_path = f"{self._path(version + 1)}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(dump_state({**state, "store_day": day, "store_created_at": time.time()}))
+        try:
+            # link fails if the file exists, so only one process writes the next version
+            os.link(tmp_path, self._path(version + 1))
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def history(self) -> list[dict]:
+        history = []
+        for version in self._versions():
+            # only small arrays are read from npz
+            with np.load(self._path(version)) as state:
+                history.append({
+                    "version": version, "day": str(state["store_day"]), "created_at": float(state["store_created_at"]),
+                })
+        return history
+
+
+def open_state_store(url: str = "memory") -> StateStore:
+    """
+    Return store by url: memory, sqlite:///path/to/file.db or file:///path/to/directory.
+    Paths follow the usual url conventions: sqlite:///state.db is relative and sqlite:////var/state.db is absolute
+    (as in SQLAlchemy), file:///var/state is absolute and file://state is relative.
+    """
+    if url == "memory":
+        return MemoryStateStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteStateStore(url[len("sqlite:///"):])
+    if url.startswith("file://"):
+        return FileStateStore(url[len("file://"):])
+    raise ValueError(f"Unknown state store {url}, it must be memory, sqlite:///path or file:///path")
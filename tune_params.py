@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+import optuna
+
+from calculate_costs import calc_costs_arrays
+from find_terminals_to_cash_out import (
+    ARMORED_CAR_PRICE, BEST_CASH_WEIGHT, BEST_NUM_OF_TERMINALS_TO_CASH_OUT, replay_season,
+)
+from get_routes import MIN_NUM_VEHICLES, estimate_min_num_vehicles
+from prepare_data import INCOMES_PATH, _cache_key, load_data_context
+
+# points: number of collected terminals per day, costs: funding, collection and fleet costs of the season
+OBJECTIVES = ("points", "costs")
+# every violation of business rules costs more than any parameters without violations
+VIOLATION_PENALTY = 10**9
+DEFAULT_STORAGE = "sqlite:///tuning.db"
+# seconds to wait for sqlite lock, workers write trials to the same file
+STORAGE_TIMEOUT = 60
+# trials in these states are counted as done when a study is resumed
+FINISHED_STATES = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+
+
+@dataclass
+class Season:
+    """Arrays to replay the season in every trial without reading source files."""
+    tids: np.ndarray
+    cash: np.ndarray  # (terminal x day) cash, the first day is initial balance
+    distance_matrix: np.ndarray
+    tid_2_idx: dict[int, int]
+
+
+def load_season() -> Season:
+    ctx = load_data_context()
+    # terminals keep order of incomes sheet, as in find_terminals_to_cash_out
+    return Season(
+        tids=ctx.cash_ts["TID"].values,
+        cash=ctx.cash_ts.drop(columns="TID").values,
+        distance_matrix=ctx.distance_matrix,
+        tid_2_idx=ctx.tid_2_idx,
+    )
+
+
+def fleet_cost(season: Season, was_collection: np.ndarray) -> float:
+    """
+    Return cost of vehicles for the season: the biggest fleet of a day is paid every day.
+    Fleet of a day is lower bound of routing by travel times, but not less than MIN_NUM_VEHICLES
+    which create_report starts routing from, so OR-tools is not run in trials.
+    """
+    num_vehicles = max(
+        (estimate_min_num_vehicles(season.distance_matrix, season.tids[collected].tolist(), season.tid_2_idx)
+         for collected in was_collection[:, 1:].T if collected.any()),
+        default=0,
+    )
+    num_vehicles = max(num_vehicles, MIN_NUM_VEHICLES)
+    return ARMORED_CAR_PRICE * num_vehicles * (season.cash.shape[1] - 1)
+
+
+def evaluate(season: Season, cash_weight: float, num_terminals: int, objective: str = "points") -> float:
+    """Return objective of parameters: the smaller the better."""
+    num_violations, was_collection = replay_season(season.cash, season.tids, num_terminals, cash_weight)
+    if objective == "points":
+        value = num_terminals
+    elif objective == "costs":
+        collection, funding, _ = calc_costs_arrays(season.cash, was_collection)
+        value = collection.sum() + funding.sum() + fleet_cost(season, was_collection)
+    else:
+        raise ValueError(f"Unknown objective {objective}, it must be one of {OBJECTIVES}")
+    return VIOLATION_PENALTY * num_violations + float(value)
+
+
+def open_storage(url: str) -> optuna.storages.RDBStorage:
+    return optuna.storages.RDBStorage(url, engine_kwargs={"connect_args": {"timeout": STORAGE_TIMEOUT}})
+
+
+def optimize(
+        study_name: str,
+        storage: str,
+        n_trials: int,
+        objective: str,
+        terminals_range: tuple[int, int],
+        seed: int,
+    ) -> int:
+    """Run n_trials trials in this process, return number of run trials."""
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    season = load_season()
+    study = optuna.load_study(
+        study_name=study_name, storage=open_storage(storage), sampler=optuna.samplers.TPESampler(seed=seed),
+    )
+
+    def trial_objective(trial: optuna.Trial) -> float:
+        cash_weight = trial.suggest_float("cash_weight", 0.01, 0.99)
+        num_terminals = trial.suggest_int("num_terminals", *terminals_range)
+        return evaluate(season, cash_weight, num_terminals, objective)
+
+    num_trials = len(study.trials)
+    study.optimize(trial_objective, n_trials=n_trials)
+    return len(study.trials) - num_trials
+
+
+def tune(
+        n_trials: int = 200,
+        num_workers: int = None,
+        objective: str = "points",
+        terminals_range: tuple[int, int] = (90, 150),
+        storage: str = DEFAULT_STORAGE,
+        study_name: str = None,
+        seed: int = 2023,
+    ) -> optuna.Study:
+    """
+    Find cash weight and number of terminals per day for PoiStats with Optuna.
+    Trials are run by num_workers processes and saved in storage, so an interrupted study is resumed
+    up to n_trials finished trials. Study name depends on incomes file, so new data gets a new study.
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Unknown objective {objective}, it must be one of {OBJECTIVES}")
+    study_name = study_name or f"poi_stats_{objective}_{_cache_key(INCOMES_PATH)}"
+    study = optuna.create_study(study_name=study_name, storage=open_storage(storage), load_if_exists=True)
+    if not study.trials:
+        # current parameters are the first guess
+        study.enqueue_trial({"cash_weight": BEST_CASH_WEIGHT, "num_terminals": BEST_NUM_OF_TERMINALS_TO_CASH_OUT})
+
+    # remaining budget of a resumed study is split between workers, so they don't run more than n_trials in total
+    remaining = max(0, n_trials - len(study.get_trials(deepcopy=False, states=FINISHED_STATES)))
+    num_workers = min(num_workers or os.cpu_count() or 1, remaining)
+    worker_trials = [remaining // num_workers + (worker < remaining % num_workers) for worker in range(num_workers)]
+    args = (study_name, storage)
+    if num_workers == 1:
+        optimize(*args, remaining, objective, terminals_range, seed)
+    elif num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # every worker has its own sampler seed, otherwise they suggest the same parameters
+            futures = [
+                executor.submit(optimize, *args, worker_trials[worker], objective, terminals_range, seed + worker)
+                for worker in range(num_workers)
+            ]
+            for future in futures:
+                future.result()
+    return optuna.load_study(study_name=study_name, storage=open_storage(storage))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune parameters of terminals selection for cash collection.")
+    parser.add_argument("--trials", type=int, default=200, help="number of finished trials of the study")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (default: all CPUs)")
+    parser.add_argument(
+        "--objective", choices=OBJECTIVES, default="points",
+        help="points: terminals per day, costs: funding, collection and fleet costs of the season",
+    )
+    parser.add_argument(
+        "--terminals", type=int, nargs=2, default=(90, 150), metavar=("MIN", "MAX"),
+        help="range of number of terminals per day",
+    )
+    parser.add_argument("--storage", default=DEFAULT_STORAGE, help="Optuna storage URL, the study is resumed from it")
+    parser.add_argument("--study", default=None, help="study name (default: by objective and incomes file)")
+    parser.add_argument("--seed", type=int, default=2023)
+    parser.add_argument("--output", default="tuned_params.json", help="JSON file with the best parameters")
+    args = parser.parse_args()
+
+    study = tune(args.trials, args.workers, args.objective, tuple(args.terminals), args.storage, args.study, args.seed)
+    best = {**study.best_params, "value": study.best_value, "study": study.study_name}
+    print(best)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(best, f, indent=2)